@@ -8,18 +8,23 @@ import csv
 import argparse
 import ast
 from os.path import isfile, isdir, join
-from os import listdir
+from os import listdir, stat, replace, getpid
 import math
 import json
-import random
 import copy
+import traceback
+from itertools import islice
+from multiprocessing import Pool
 
 from shapely.geometry import LineString, shape
+from shapely.strtree import STRtree
 import numpy
 
 EXPECTED_HEADER = ['ID', 'name', 'polyline_points', 'total_time_in_sec', 'total_distance_in_meters',
                    'number_of_steps', 'maneuvers', 'beauty', 'simplicity', 'pctNonHighwayTime',
                    'pctNonHighwayDist', 'pctNeiTime', 'pctNeiDist']
+SAMPLE_STEP = 0.0025  # distance in decimal degrees between points sampled along a route
+CSV_BATCH_SIZE = 10000  # number of routes read in at once when filtering them against the baselines
 
 def convert_xy_to_cr(coord, precision=3):
     """Convert polyline coordinates to column-row IDs used by grid cells.
@@ -67,11 +72,118 @@ def get_baselines(city, routetype):
     return baseline_times
 
 
-def get_grid_ct_dict(fn):
+class BaselineIndex(object):
+    """Sorted array of route IDs and times for the GraphHopper fastest routes, for matching many routes at once."""
+
+    def __init__(self, ids, times):
+        order = numpy.argsort(ids, kind="stable")
+        self.ids = numpy.asarray(ids)[order]
+        self.times = numpy.asarray(times, dtype=numpy.float64)[order]
+
+    def lookup(self, route_ids, default=-1):
+        """Get baseline times for an array of route IDs (default for routes without a baseline)."""
+        route_ids = numpy.asarray(route_ids, dtype=str)
+        times = numpy.full(len(route_ids), default, dtype=numpy.float64)
+        if not len(self.ids):
+            return times
+        positions = numpy.minimum(numpy.searchsorted(self.ids, route_ids), len(self.ids) - 1)
+        found = self.ids[positions] == route_ids
+        times[found] = self.times[positions[found]]
+        return times
+
+
+# Baselines loaded so far this run - keyed by (city, routetype) - so that they are only read once
+_baseline_indices = {}
+
+
+def get_baseline_index(city, routetype, cache=True):
+    """Sorted route IDs and times for GraphHopper fastest route to compare against.
+
+    Loaded once per city and route type for the whole run and optionally stored in binary form alongside the CSV.
+    """
+    if (city, routetype) in _baseline_indices:
+        return _baseline_indices[(city, routetype)]
+    fn = "data/routes/{0}_{1}_gh_routes_fast.csv".format(city, routetype)
+    cache_fn = fn.replace(".csv", "_baseline.npz")
+    cached = load_cache(cache_fn, [fn]) if cache else None
+    if cached is not None:
+        baseline_index = BaselineIndex(cached['ids'], cached['times'])
+    else:
+        baseline_times = get_baselines(city, routetype)
+        baseline_index = BaselineIndex(list(baseline_times.keys()), list(baseline_times.values()))
+        if cache:
+            save_cache(cache_fn, [fn], ids=baseline_index.ids, times=baseline_index.times)
+    _baseline_indices[(city, routetype)] = baseline_index
+    return baseline_index
+
+
+def source_signature(source_fns):
+    """Size and modification time of each source file, used to tell whether a cached lookup is out of date."""
+    return numpy.array([[stat(fn).st_size, stat(fn).st_mtime_ns] for fn in source_fns], dtype=numpy.int64)
+
+
+def load_cache(cache_fn, source_fns):
+    """Load arrays cached by save_cache.
+
+    Returns:
+        Dictionary of cached arrays or None if there is no cache or the source files have changed since it was saved
+    """
+    if not isfile(cache_fn):
+        return None
+    try:
+        with numpy.load(cache_fn) as cached:
+            if numpy.array_equal(cached['source_signature'], source_signature(source_fns)):
+                return {k: cached[k] for k in cached.files if k != 'source_signature'}
+    except (OSError, ValueError, KeyError):
+        print("\tIgnoring unreadable cache {0}".format(cache_fn))
+    return None
+
+
+def save_cache(cache_fn, source_fns, **arrays):
+    """Save arrays computed from source files to a compact binary (.npz) file alongside them."""
+    tmp_fn = "{0}.{1}.tmp".format(cache_fn, getpid())
+    with open(tmp_fn, 'wb') as fout:
+        numpy.savez(fout, source_signature=source_signature(source_fns), **arrays)
+    replace(tmp_fn, cache_fn)  # atomic so that concurrent runs never see a partially-written cache
+
+
+def load_grid_ct_cells(fn, cache=True):
+    """Load grid cell column IDs, row IDs, and census tract indices from a grid to census tract CSV.
+
+    Args:
+        fn: path to CSV file containing mapping of grid cells to census tracts
+        cache: True if the cells should be loaded from / saved to a binary cache alongside the CSV
+    Returns:
+        xs, ys, cts: parallel int32 arrays of the grid cells and the census tract indices that they intersect
+    """
+    cache_fn = fn.replace(".csv", "_cache.npz")
+    if cache:
+        cached = load_cache(cache_fn, [fn])
+        if cached is not None:
+            return cached['xs'], cached['ys'], cached['cts']
+    with open(fn, 'r') as fin:
+        assert next(csv.reader(fin)) == ['x','y','ctidx']
+        cells = numpy.loadtxt(fin, delimiter=',', dtype=numpy.int32, ndmin=2).reshape(-1, 3)
+    xs, ys, cts = cells[:, 0].copy(), cells[:, 1].copy(), cells[:, 2].copy()
+    if cache:
+        save_cache(cache_fn, [fn], xs=xs, ys=ys, cts=cts)
+    return xs, ys, cts
+
+
+def parse_time(time_str):
+    """Route time in seconds or -1 if missing / invalid."""
+    try:
+        return float(time_str)
+    except ValueError:
+        return -1
+
+
+def get_grid_ct_dict(fn, cache=True):
     """Load in mapping of x,y coordinates to census tracts.
 
     Args:
         fn: path to CSV file containing mapping of grid cells to census tracts
+        cache: True if the mapping should be loaded from / saved to a binary cache alongside the CSV
     Returns:
         rc_to_ct: dictionary of grid cells mapped to ID of census tract ID that they intersect
 
@@ -79,27 +191,140 @@ def get_grid_ct_dict(fn):
         x,y is equivalent to column,row is equivalent to lon,lat.
         Coordinates are stored as integers that are the true coordinates times 10**3 (e.g. 40.523 is stored as 40523)
     """
-    rc_to_ct = {}
-    with open(fn, 'r') as fin:
-        csvreader = csv.reader(fin)
-        assert next(csvreader) == ['x','y','ctidx']
-        for line in csvreader:
-            x = int(line[0])
-            y = int(line[1])
-            ct = int(line[2])
-            rc_to_ct[(y,x)] = ct
-    return rc_to_ct
+    xs, ys, cts = load_grid_ct_cells(fn, cache=cache)
+    return dict(zip(zip(ys.tolist(), xs.tolist()), cts.tolist()))
+
 
+class GridRaster(object):
+    """Dense lookup table of grid cells to census tract indices.
 
-def get_hmi_mapping(censusfn, geojsonfn):
+    Grid cells are stored in an int32 array covering the bounding box of all cells, offset by the row and column IDs
+    of its south-west corner. Cells that do not intersect a census tract are stored as NO_TRACT. Supports bulk lookups
+    of coordinate arrays via lookup() as well as the same (y, x) indexing as the dictionary from get_grid_ct_dict.
+    """
+
+    NO_TRACT = -1
+
+    def __init__(self, table, min_y, min_x):
+        self.table = table
+        self.min_y = min_y
+        self.min_x = min_x
+
+    @classmethod
+    def from_cells(cls, xs, ys, cts):
+        """Build raster from parallel arrays of grid cell column IDs, row IDs, and census tract indices."""
+        xs = numpy.asarray(xs, dtype=numpy.int64)
+        ys = numpy.asarray(ys, dtype=numpy.int64)
+        if not len(xs):
+            return cls(numpy.full((0, 0), cls.NO_TRACT, dtype=numpy.int32), 0, 0)
+        min_y = int(ys.min())
+        min_x = int(xs.min())
+        table = numpy.full((int(ys.max()) - min_y + 1, int(xs.max()) - min_x + 1), cls.NO_TRACT, dtype=numpy.int32)
+        table[ys - min_y, xs - min_x] = cts
+        return cls(table, min_y, min_x)
+
+    def lookup(self, ys, xs):
+        """Get census tract indices for arrays of grid cell row and column IDs (NO_TRACT if outside all tracts)."""
+        rows = numpy.asarray(ys, dtype=numpy.int64) - self.min_y
+        cols = numpy.asarray(xs, dtype=numpy.int64) - self.min_x
+        inside = (rows >= 0) & (rows < self.table.shape[0]) & (cols >= 0) & (cols < self.table.shape[1])
+        cts = numpy.full(rows.shape, self.NO_TRACT, dtype=numpy.int32)
+        cts[inside] = self.table[rows[inside], cols[inside]]
+        return cts
+
+    def __getitem__(self, rc):
+        ct = self.lookup(rc[0], rc[1])
+        if ct == self.NO_TRACT:
+            raise KeyError(rc)
+        return int(ct)
+
+    def __contains__(self, rc):
+        return self.lookup(rc[0], rc[1]) != self.NO_TRACT
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.table != self.NO_TRACT))
+
+
+def get_grid_ct_raster(fn, cache=True):
+    """Load in mapping of x,y coordinates to census tracts as a dense raster.
+
+    Args:
+        fn: path to CSV file containing mapping of grid cells to census tracts
+        cache: True if the mapping should be loaded from / saved to a binary cache alongside the CSV
+    Returns:
+        GridRaster of grid cells mapped to the index of the census tract that they intersect
+    """
+    xs, ys, cts = load_grid_ct_cells(fn, cache=cache)
+    return GridRaster.from_cells(xs, ys, cts)
+
+
+def lookup_cts(rc_to_ct, ys, xs):
+    """Get census tract indices for arrays of grid cell row and column IDs.
+
+    Args:
+        rc_to_ct: GridRaster or dictionary mapping gridcell row, column IDs to census tract indices
+        ys: grid cell row IDs
+        xs: grid cell column IDs
+    Returns:
+        Array of census tract indices with GridRaster.NO_TRACT for grid cells not in any census tract
+    """
+    if isinstance(rc_to_ct, GridRaster):
+        return rc_to_ct.lookup(ys, xs)
+    return numpy.fromiter((rc_to_ct.get((y, x), GridRaster.NO_TRACT) for y, x in zip(ys, xs)),
+                          dtype=numpy.int64, count=len(ys))
+
+
+def get_ct_adjacency(geojsonfn, features, cache=True):
+    """Determine which census tracts neighbor each other.
+
+    Args:
+        geojsonfn: path to GeoJSON containing census tract geography
+        features: census tract features loaded from geojsonfn
+        cache: True if the adjacency graph should be loaded from / saved to a binary cache alongside the GeoJSON
+            (e.g. sf_ct.geojson -> sf_ct_adjacency.npz)
+    Returns:
+        adjacency: dictionary mapping each census tract index to a list of indices of census tracts that intersect it
+    """
+    cache_fn = geojsonfn.replace(".geojson", "_adjacency.npz")
+    if cache:
+        cached = load_cache(cache_fn, [geojsonfn])
+        if cached is not None:
+            # neighbors of census tract i are neighbors[starts[i]:starts[i + 1]]
+            starts = cached['starts'].tolist()
+            neighbors = cached['neighbors'].tolist()
+            return {i: neighbors[starts[i]:starts[i + 1]] for i in range(0, len(starts) - 1)}
+
+    shapes = [shape(ft['geometry']) for ft in features]
+    tree = STRtree(shapes)
+    adjacency = {i: [] for i in range(0, len(shapes))}
+    # all pairs of intersecting census tracts, found by bounding box in the tree and then checked exactly
+    for i, j in zip(*tree.query(shapes, predicate="intersects").tolist()):
+        if i != j:
+            adjacency[i].append(j)
+    for i in adjacency:
+        adjacency[i].sort()
+    if cache:
+        save_cache(cache_fn, [geojsonfn],
+                   starts=numpy.cumsum([0] + [len(adjacency[i]) for i in range(0, len(shapes))], dtype=numpy.int64),
+                   neighbors=numpy.array([j for i in range(0, len(shapes)) for j in adjacency[i]], dtype=numpy.int64))
+    return adjacency
+
+
+def get_hmi_mapping(censusfn, geojsonfn, cache=True):
     """Generate mapping of census tracts IDs to HMI data.
 
     Args:
         censusfn: path to CSV containing HMI data for census tracts.
         geojsonfn: path to GeoJSON containing census tract geography (determines census tracts indices used)
+        cache: True if the mapping should be loaded from / saved to a binary cache alongside the GeoJSON
     Returns:
         ctidx_to_hmi: dictionary mapping census tract indices from GeoJSON file to HMI data from CSV
     """
+    cache_fn = geojsonfn.replace(".geojson", "_hmi_cache.npz")
+    if cache:
+        cached = load_cache(cache_fn, [censusfn, geojsonfn])
+        if cached is not None:
+            return dict(zip(cached['ctidx'].tolist(), cached['hmi'].tolist()))
 
     # Map Census Tract Name (some sort of unique identifier) to index at which it appears in GeoJSON
     with open(geojsonfn, 'r') as fin:
@@ -150,40 +375,164 @@ def get_hmi_mapping(censusfn, geojsonfn):
     if recalc:
         print("\tCalculating HMI for {0} based on neighbors".format(recalc))
         recalculated_hmis = {}
-        for ft in gj['features']:
-            ft['properties']['shape'] = shape(ft['geometry'])
+        adjacency = get_ct_adjacency(geojsonfn, gj['features'], cache=cache)
         for idx in recalc:
             neighbors = []
-            recalc_shape = gj['features'][round(idx)]['properties']['shape']
-            for i in range(0, len(gj['features'])):
-                if i != idx:
-                    if gj['features'][i]['properties']['shape'].intersects(recalc_shape):
-                        try:
-                            if ctidx_to_hmi[i] > 0:
-                                neighbors.append(ctidx_to_hmi[i])
-                        except KeyError:
-                            continue
+            for i in adjacency[round(idx)]:
+                try:
+                    if ctidx_to_hmi[i] > 0:
+                        neighbors.append(ctidx_to_hmi[i])
+                except KeyError:
+                    continue
             if neighbors:
                 recalculated_hmis[idx] = numpy.average(neighbors)
         for idx in recalculated_hmis:
             ctidx_to_hmi[idx] = recalculated_hmis[idx]
+
+    if cache:
+        save_cache(cache_fn, [censusfn, geojsonfn],
+                   ctidx=numpy.array(list(ctidx_to_hmi.keys()), dtype=numpy.float64),
+                   hmi=numpy.array(list(ctidx_to_hmi.values()), dtype=numpy.float64))
     return ctidx_to_hmi
 
 
-def cts_from_polyline(polyline, rc_to_ct, ct_entropy={}, weight=1):
+def grid_traversal(polyline, precision=3):
+    """Walk a polyline through the grid cells and measure the length spent in each cell.
+
+    Each segment is split at every grid line that it crosses so the length within each cell is exact rather than
+    estimated from samples along the line. Cells follow the same convention as convert_xy_to_cr (i.e. a coordinate
+    belongs to the cell of its rounded integer representation).
+
+    Args:
+        polyline: list of coordinates (e.g. [(lat1, lon1), (lat2, lon2), ...]
+        precision: number of decimal places used by the grid cell IDs
+    Returns:
+        ys: row IDs of the grid cells passed through
+        xs: column IDs of the grid cells passed through
+        lengths: length (in decimal degrees) of the polyline within each of the grid cells
+    """
+    coords = numpy.asarray(polyline, dtype=numpy.float64).reshape(-1, 2)
+    # shift by half a cell so that flooring matches the rounding done by convert_xy_to_cr
+    ys = coords[:, 0] * 10**precision + 0.5
+    xs = coords[:, 1] * 10**precision + 0.5
+    y0, y1 = ys[:-1], ys[1:]
+    x0, x1 = xs[:-1], xs[1:]
+    dy = y1 - y0
+    dx = x1 - x0
+    seg_lengths = numpy.hypot(dy, dx) / 10**precision
+    num_segs = len(seg_lengths)
+
+    # parameters (0 to 1 along each segment) at which the segment starts, ends, and crosses a grid line
+    seg_ids = [numpy.arange(num_segs), numpy.arange(num_segs)]
+    ts = [numpy.zeros(num_segs), numpy.ones(num_segs)]
+    for start, delta in ((y0, dy), (x0, dx)):
+        lo = numpy.minimum(start, start + delta)
+        hi = numpy.maximum(start, start + delta)
+        first = numpy.floor(lo) + 1
+        num_crossings = numpy.maximum(numpy.ceil(hi) - first, 0).astype(numpy.int64)
+        total = num_crossings.sum()
+        if not total:
+            continue
+        crossing_segs = numpy.repeat(numpy.arange(num_segs), num_crossings)
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(num_crossings) - num_crossings, num_crossings)
+        gridlines = first[crossing_segs] + offsets
+        seg_ids.append(crossing_segs)
+        ts.append((gridlines - start[crossing_segs]) / delta[crossing_segs])
+    seg_ids = numpy.concatenate(seg_ids)
+    ts = numpy.concatenate(ts)
+    order = numpy.lexsort((ts, seg_ids))
+    seg_ids = seg_ids[order]
+    ts = ts[order]
+
+    # each consecutive pair of parameters on the same segment bounds a piece that lies within a single grid cell
+    same_seg = seg_ids[1:] == seg_ids[:-1]
+    piece_segs = seg_ids[:-1][same_seg]
+    t_start = ts[:-1][same_seg]
+    t_end = ts[1:][same_seg]
+    lengths = (t_end - t_start) * seg_lengths[piece_segs]
+    nonzero = lengths > 0
+    piece_segs = piece_segs[nonzero]
+    t_mid = ((t_start + t_end) / 2)[nonzero]
+    lengths = lengths[nonzero]
+    cell_ys = numpy.floor(y0[piece_segs] + t_mid * dy[piece_segs]).astype(numpy.int64)
+    cell_xs = numpy.floor(x0[piece_segs] + t_mid * dx[piece_segs]).astype(numpy.int64)
+
+    if not len(lengths):
+        return cell_ys, cell_xs, lengths
+    cells, inverse = numpy.unique(numpy.stack((cell_ys, cell_xs), axis=1), axis=0, return_inverse=True)
+    lengths = numpy.bincount(inverse.ravel(), weights=lengths, minlength=len(cells))
+    return cells[:, 0], cells[:, 1], lengths
+
+
+def polyline_ct_lengths(polyline, rc_to_ct):
+    """Determine the exact distance spent in each census tract by a route.
+
+    Args:
+        polyline: list or array of coordinates (e.g. [(lat1, lon1), (lat2, lon2), ...]
+        rc_to_ct: GridRaster or dictionary mapping gridcell row, column IDs to census tract indices
+    Returns:
+        cts: indices of the census tracts passed through
+        ct_lengths: distance spent in each of those census tracts in units of SAMPLE_STEP
+    """
+    ys, xs, lengths = grid_traversal(polyline)
+    cts = lookup_cts(rc_to_ct, ys, xs)
+    found = cts != GridRaster.NO_TRACT
+    cts, inverse = numpy.unique(cts[found], return_inverse=True)
+    ct_lengths = numpy.bincount(inverse.ravel(), weights=lengths[found], minlength=len(cts)) / SAMPLE_STEP
+    return cts, ct_lengths
+
+
+def accumulate_weighted_cts(polyline_cts, weights, ct_entropies):
+    """Apply any number of weights to the census tract distances of many routes at once.
+
+    Args:
+        polyline_cts: list of (cts, ct_lengths) for each route as returned by polyline_ct_lengths
+        weights: array with a row for each route and a column for each ct_entropy dictionary to be updated
+            (a weight of 0 excludes a route from that dictionary)
+        ct_entropies: list of dictionaries tracking the relative distance spent in each census tract
+    Returns:
+        Void. Updates each dictionary in ct_entropies with the routes weighted by the corresponding column of weights.
+        Census tracts with a total weight of 0 are not added, so a dictionary whose weights are all 0 stays empty
+        (compute_hmi gives nan HMI stats for it).
+    """
+    if not polyline_cts:
+        return
+    weights = numpy.asarray(weights, dtype=numpy.float64).reshape(len(polyline_cts), len(ct_entropies))
+    route_ids = numpy.repeat(numpy.arange(len(polyline_cts)), [len(cts) for cts, _ in polyline_cts])
+    cts = numpy.concatenate([cts for cts, _ in polyline_cts])
+    ct_lengths = numpy.concatenate([ct_lengths for _, ct_lengths in polyline_cts])
+    cts, inverse = numpy.unique(cts, return_inverse=True)
+    inverse = inverse.ravel()
+    for i, ct_entropy in enumerate(ct_entropies):
+        totals = numpy.bincount(inverse, weights=ct_lengths * weights[route_ids, i], minlength=len(cts))
+        for ct, total in zip(cts.tolist(), totals.tolist()):
+            if total:
+                ct_entropy[ct] = ct_entropy.get(ct, 0) + total
+
+
+def cts_from_polyline(polyline, rc_to_ct, ct_entropy={}, weight=1, method="traverse"):
     """Determine relative distance spent in each census tract by a route.
 
     Args:
         polyline: list of coordinates (e.g. [(lat1, lon1), (lat2, lon2), ...]
-        rc_to_ct: Dictionary mapping gridcell row, column IDs to census tract indices
+        rc_to_ct: GridRaster or dictionary mapping gridcell row, column IDs to census tract indices
         ct_entropy: dictionary tracking the relative distance spent by all routes in each census tract
             (e.g. {<ct 3>: 7, <ct 4>: 15, ...})
         weight: weight to give a particular route.
+        method: 'traverse' to measure the exact length spent in each grid cell or 'sample' to sample points every
+            SAMPLE_STEP decimal degrees along the route. Traversal lengths are expressed in units of SAMPLE_STEP so
+            that both methods produce values on the same scale.
     Returns:
         Void. Updates ct_entropy dictionary with values from the input polyline.
     """
-    polyline = copy.deepcopy(polyline)
     num_coordinates = len(polyline)
+    if method == "traverse" and num_coordinates > 1:
+        cts, ct_lengths = polyline_ct_lengths(polyline, rc_to_ct)
+        for ct, length in zip(cts.tolist(), ct_lengths.tolist()):
+            ct_entropy[ct] = ct_entropy.get(ct, 0) + (length * weight)
+        return
+
+    polyline = copy.deepcopy(polyline)
     pts_processed = 0
     pts_not_found = 0
     if num_coordinates <= 2:
@@ -206,7 +555,7 @@ def cts_from_polyline(polyline, rc_to_ct, ct_entropy={}, weight=1):
         poly_length = polyline.length
         while dist_along_line < poly_length:
             pt = polyline.interpolate(dist_along_line)
-            dist_along_line += 0.0025  # this is actually in decimal degrees but provides a good level of sampling
+            dist_along_line += SAMPLE_STEP  # this is actually in decimal degrees but provides a good level of sampling
             y = convert_xy_to_cr(pt.y)
             x = convert_xy_to_cr(pt.x)
             pts_processed += 1
@@ -234,7 +583,8 @@ def compute_entropy(occurence_dictionary):
     return entropy
 
 
-def compute_hmi(occurence_dictionary, ctidx_to_hmi, bootstrap=False, alpha=0.01, num_iter=1000):
+def compute_hmi(occurence_dictionary, ctidx_to_hmi, bootstrap=False, alpha=0.01, num_iter=1000, seed=None,
+                batch_size=1000, verbose=True):
     """Compute weighted HMI of census tracts passed through.
 
     Args:
@@ -243,6 +593,9 @@ def compute_hmi(occurence_dictionary, ctidx_to_hmi, bootstrap=False, alpha=0.01,
         bootstrap: True if weighted HMI should be bootstrapped for confidence intervals
         alpha: confidence level if bootstrapping - alpha of 0.01 corresponds to 99% significance level
         num_iter: # of iterations to use for bootstrapping.
+        seed: seed for the random number generator used for bootstrapping (None for a fresh seed each call)
+        batch_size: # of bootstrap iterations to resample at once (bounds memory at batch_size x # census tracts)
+        verbose: True if census tracts left out of the calculations should be printed out
     Returns:
         hmi_stats: dictionary containing weighted mean HMI of census tracts passed through and upper and lower bounds
             if bootstrapping also used.
@@ -253,37 +606,48 @@ def compute_hmi(occurence_dictionary, ctidx_to_hmi, bootstrap=False, alpha=0.01,
         try:
             if ctidx_to_hmi[ctidx] == -1:
                 del(occurence_dictionary[ctidx])
-                print("\tRemoved {0} from HMI calculations.".format(ctidx))
+                if verbose:
+                    print("\tRemoved {0} from HMI calculations.".format(ctidx))
         except KeyError:
-            print("\t{0} not in HMI calculations.".format(ctidx))
-
-    num_ct_points = sum(occurence_dictionary.values())
+            if verbose:
+                print("\t{0} not in HMI calculations.".format(ctidx))
+
+    # no census tracts with HMI data (e.g. a route entirely outside the census tracts or no segments for a traffic
+    # group) leaves nothing to weight
+    if sum(occurence_dictionary.values()) <= 0:
+        hmi_stats['LB_hmi_w'] = numpy.nan if bootstrap else None
+        hmi_stats['UB_hmi_w'] = numpy.nan if bootstrap else None
+        hmi_stats['mean_hmi_w'] = numpy.nan
+        return hmi_stats
+
+    # occurrences may be fractional (e.g. lengths from grid traversal) so resample the equivalent number of points
+    num_ct_points = max(1, round(sum(occurence_dictionary.values())))
+    cts = list(occurence_dictionary.keys())
+    weights = [occurence_dictionary[k] for k in cts]
     if bootstrap:
-        hmi_w = []
-        cts = []
-        for k in occurence_dictionary:
-            cts += [k] * occurence_dictionary[k]
-        assert len(cts) == num_ct_points
-        for i in range(0, num_iter):
-            resampled_hmi = []
-            for i in range(0, num_ct_points):
-                resampled_hmi.append(ctidx_to_hmi[cts[random.randint(0, num_ct_points - 1)]])
-            hmi_w.append(numpy.average(resampled_hmi))
-        hmi_w = sorted(hmi_w)
+        # Resample census tract counts directly rather than individual points: each iteration draws num_ct_points
+        # points across the census tracts in proportion to the distance spent in each.
+        rng = numpy.random.default_rng(seed)
+        hmis = numpy.array([ctidx_to_hmi[ct] for ct in cts], dtype=numpy.float64)
+        probabilities = numpy.array(weights, dtype=numpy.float64)
+        probabilities /= probabilities.sum()
+        hmi_w = numpy.empty(num_iter)
+        for start in range(0, num_iter, batch_size):
+            size = min(batch_size, num_iter - start)
+            resampled_counts = rng.multinomial(num_ct_points, probabilities, size=size)
+            hmi_w[start:start + size] = resampled_counts.dot(hmis) / num_ct_points
+        hmi_w.sort()
         hmi_stats['LB_hmi_w'] = hmi_w[int(num_iter * (alpha / 2))]
         hmi_stats['UB_hmi_w'] = hmi_w[int(num_iter * (1 - (alpha / 2)))]
         hmi_stats['mean_hmi_w'] = hmi_w[int(num_iter*0.5)]
     else:
-        hmi_w = []
-        for ctidx in occurence_dictionary:
-            hmi_w += [ctidx_to_hmi[ctidx]] * occurence_dictionary[ctidx]
         hmi_stats['LB_hmi_w'] = None
         hmi_stats['UB_hmi_w'] = None
-        hmi_stats['mean_hmi_w'] = numpy.average(hmi_w)
+        hmi_stats['mean_hmi_w'] = numpy.average([ctidx_to_hmi[ct] for ct in cts], weights=weights)
     return hmi_stats
 
 
-def ct_stats_geojson(geojson, rc_to_ct, ct_to_hmi):
+def ct_stats_geojson(geojson, rc_to_ct, ct_to_hmi, verbose=True):
     """Process HMI statistics for GeoJSON containing route segments and counts.
 
     This analysis depends on the difference in road segments taken by an alternative routing algorithm and baseline
@@ -291,10 +655,11 @@ def ct_stats_geojson(geojson, rc_to_ct, ct_to_hmi):
 
     Args:
         geojson: File path of GeoJSON with route segments and counts (and CIs) of routes that took each segment
-        rc_to_ct: Dictionary mapping gridcell row, column IDs to census tract indices
+        rc_to_ct: GridRaster or dictionary mapping gridcell row, column IDs to census tract indices
         ct_to_hmi: Dictionary mapping census tract indices to the HMI of that census tract
+        verbose: True if HMI stats should also be printed out
     Returns:
-        Void. Prints out HMI stats for both the roads favored and avoided by the routing algorithm
+        stats: dictionary of HMI stats for both the roads favored and avoided by the routing algorithm
     """
     with open(geojson, 'r') as fin:
         segments = json.load(fin)
@@ -309,53 +674,62 @@ def ct_stats_geojson(geojson, rc_to_ct, ct_to_hmi):
     pos_processed = 0
     neg_processed = 0
     segs_skipped = 0
+    seg_cts = []
+    seg_weights = []  # columns: pos med, pos lb, pos ub, neg med, neg lb, neg ub
     for seg in segments['features']:
         if seg['properties']['sig']:
             segs_processed += 1
-            lineseg = seg['geometry']['coordinates']
             count = seg['properties']['med']
-            # swap coordinates for GeoJSON specification
-            for i in range(0, len(lineseg)):
-                tmp = lineseg[i][0]
-                lineseg[i][0] = lineseg[i][1]
-                lineseg[i][1] = tmp
+            lb = seg['properties']['lb']
+            ub = seg['properties']['ub']
             # Increased traffic
             if count > 0:
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_pos, weight=count)
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_pos_LB, weight=seg['properties']['lb'])
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_pos_UB, weight=seg['properties']['ub'])
+                seg_weights.append([count, lb, ub, 0, 0, 0])
                 pos_processed += 1
             # Decreased traffic
             elif count < 0:
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_neg, weight=abs(count))
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_neg_LB, weight=abs(seg['properties']['lb']))
-                cts_from_polyline(lineseg, rc_to_ct, ct_entropy=ct_entropy_neg_UB, weight=abs(seg['properties']['ub']))
+                seg_weights.append([0, 0, 0, abs(count), abs(lb), abs(ub)])
                 neg_processed += 1
+            else:
+                continue
+            # swap coordinates for GeoJSON specification
+            lineseg = numpy.asarray(seg['geometry']['coordinates'], dtype=numpy.float64)[:, [1, 0]]
+            seg_cts.append(polyline_ct_lengths(lineseg, rc_to_ct))
         else:
             segs_skipped += 1
 
-    hmi_stats_pos = compute_hmi(ct_entropy_pos, ct_to_hmi, bootstrap=False)
-    hmi_stats_pos_LB = compute_hmi(ct_entropy_pos_LB, ct_to_hmi, bootstrap=False)
-    hmi_stats_pos_UB = compute_hmi(ct_entropy_pos_UB, ct_to_hmi, bootstrap=False)
-    hmi_stats_neg = compute_hmi(ct_entropy_neg, ct_to_hmi, bootstrap=False)
-    hmi_stats_neg_LB = compute_hmi(ct_entropy_neg_LB, ct_to_hmi, bootstrap=False)
-    hmi_stats_neg_UB = compute_hmi(ct_entropy_neg_UB, ct_to_hmi, bootstrap=False)
+    # each segment's census tracts are only computed once and then weighted for both traffic groups in one pass
+    accumulate_weighted_cts(seg_cts, seg_weights, [ct_entropy_pos, ct_entropy_pos_LB, ct_entropy_pos_UB,
+                                                   ct_entropy_neg, ct_entropy_neg_LB, ct_entropy_neg_UB])
+
+    hmi_stats_pos = compute_hmi(ct_entropy_pos, ct_to_hmi, bootstrap=False, verbose=verbose)
+    hmi_stats_pos_LB = compute_hmi(ct_entropy_pos_LB, ct_to_hmi, bootstrap=False, verbose=verbose)
+    hmi_stats_pos_UB = compute_hmi(ct_entropy_pos_UB, ct_to_hmi, bootstrap=False, verbose=verbose)
+    hmi_stats_neg = compute_hmi(ct_entropy_neg, ct_to_hmi, bootstrap=False, verbose=verbose)
+    hmi_stats_neg_LB = compute_hmi(ct_entropy_neg_LB, ct_to_hmi, bootstrap=False, verbose=verbose)
+    hmi_stats_neg_UB = compute_hmi(ct_entropy_neg_UB, ct_to_hmi, bootstrap=False, verbose=verbose)
 
     # Note: because LB and UB are computed based on change in route segments and not change in HMI, sometimes the LB
     # is higher than the UB and vice versa. This is not perfect but should not introduce any bias.
-    print("\tMore Traffic: HMI: {0} [{1}-{2}]".format(round(hmi_stats_pos['mean_hmi_w'], 3),
-                                                      round(min(hmi_stats_pos_LB['mean_hmi_w'],
-                                                                hmi_stats_pos_UB['mean_hmi_w']), 3),
-                                                      round(max(hmi_stats_pos_LB['mean_hmi_w'],
-                                                                hmi_stats_pos_UB['mean_hmi_w']), 3)))
-    print("\tLess Traffic: HMI: {0} [{1}-{2}]".format(round(hmi_stats_neg['mean_hmi_w'], 3),
-                                                      round(min(hmi_stats_neg_LB['mean_hmi_w'],
-                                                                hmi_stats_neg_UB['mean_hmi_w']), 3),
-                                                      round(max(hmi_stats_neg_LB['mean_hmi_w'],
-                                                                hmi_stats_neg_UB['mean_hmi_w']), 3)))
-
-            
-def ct_stats_csv(fn, rc_to_ct, ct_to_hmi, diffonly=True):
+    stats = {'input_fn': geojson, 'segs_processed': segs_processed, 'pos_processed': pos_processed,
+             'neg_processed': neg_processed, 'segs_skipped': segs_skipped}
+    for direction, hmi_stats, hmi_stats_LB, hmi_stats_UB in [('pos', hmi_stats_pos, hmi_stats_pos_LB, hmi_stats_pos_UB),
+                                                             ('neg', hmi_stats_neg, hmi_stats_neg_LB, hmi_stats_neg_UB)]:
+        stats['{0}_mean_hmi_w'.format(direction)] = round(hmi_stats['mean_hmi_w'], 3)
+        stats['{0}_LB_hmi_w'.format(direction)] = round(min(hmi_stats_LB['mean_hmi_w'], hmi_stats_UB['mean_hmi_w']), 3)
+        stats['{0}_UB_hmi_w'.format(direction)] = round(max(hmi_stats_LB['mean_hmi_w'], hmi_stats_UB['mean_hmi_w']), 3)
+
+    if verbose:
+        print("\tMore Traffic: HMI: {0} [{1}-{2}]".format(stats['pos_mean_hmi_w'],
+                                                          stats['pos_LB_hmi_w'],
+                                                          stats['pos_UB_hmi_w']))
+        print("\tLess Traffic: HMI: {0} [{1}-{2}]".format(stats['neg_mean_hmi_w'],
+                                                          stats['neg_LB_hmi_w'],
+                                                          stats['neg_UB_hmi_w']))
+    return stats
+
+
+def ct_stats_csv(fn, rc_to_ct, ct_to_hmi, diffonly=True, num_iter=1000, seed=None, verbose=True):
     """Process HMI statistics for CSV containing route polylines.
 
     This analysis provides the HMI of the routes for a particular algorithm and is most useful when compared to
@@ -364,50 +738,138 @@ def ct_stats_csv(fn, rc_to_ct, ct_to_hmi, diffonly=True):
 
     Args:
         fn: File path of CSV with route polylines
-        rc_to_ct: Dictionary mapping gridcell row, column IDs to census tract indices
+        rc_to_ct: GridRaster or dictionary mapping gridcell row, column IDs to census tract indices
         ct_to_hmi: Dictionary mapping census tract indices to the HMI of that census tract
         diffonly: True if only include routes that differ from the fastest path baseline.
+        num_iter: # of iterations to use for bootstrapping the weighted HMI.
+        seed: seed for bootstrapping (None for non-deterministic results).
+        verbose: True if HMI stats should also be printed out
     Returns:
-        Void. Prints out HMI stats for the roads taken by the routing algorithm
+        stats: dictionary of HMI stats for the roads taken by the routing algorithm
     """
     if diffonly:
         if 'sf' in fn:
-            baseline_times = get_baselines("sf", get_routetype(fn))
+            baseline_index = get_baseline_index("sf", get_routetype(fn))
         elif 'nyc' in fn:
-            baseline_times = get_baselines("nyc", get_routetype(fn))
+            baseline_index = get_baseline_index("nyc", get_routetype(fn))
     ct_entropy = {}
+    lines_processed = 0
+    lines_skipped = 0
+    lines_failed = 0
     with open(fn, 'r') as fin:
         csvreader = csv.reader(fin)
         header = next(csvreader)
         polyline_idx = header.index("polyline_points")
         time_idx = header.index("total_time_in_sec")
         route_idx = header.index("ID")
-        lines_processed = 0
-        lines_skipped = 0
-        lines_failed = 0
-        for line in csvreader:
-            if not diffonly or (float(line[time_idx]) > 0 and
-                                        float(line[time_idx]) != baseline_times.get(line[route_idx], -1)):
+        while True:
+            lines = list(islice(csvreader, CSV_BATCH_SIZE))
+            if not lines:
+                break
+            if diffonly:
+                # only keep routes that differ from the fastest route (matched against the baseline all at once)
+                times = numpy.array([parse_time(line[time_idx]) for line in lines])
+                baseline_times = baseline_index.lookup([line[route_idx] for line in lines])
+                keep = (times > 0) & (times != baseline_times)
+            else:
+                keep = numpy.ones(len(lines), dtype=bool)
+            lines_skipped += int(len(lines) - keep.sum())
+            for i in numpy.flatnonzero(keep):
                 lines_processed += 1
                 try:
-                    cts_from_polyline(ast.literal_eval(line[polyline_idx]), rc_to_ct, ct_entropy=ct_entropy)
+                    cts_from_polyline(ast.literal_eval(lines[i][polyline_idx]), rc_to_ct, ct_entropy=ct_entropy)
                 except Exception:
                     lines_failed += 1
-            else:
-                lines_skipped += 1
 
-    print("\t{0} lines processed and {1} failed and {2} skipped.".format(lines_processed, lines_failed, lines_skipped))
-    print("\tCensus Tract entropy: {0}".format(compute_entropy(ct_entropy)))
-    hmi_stats = compute_hmi(ct_entropy, ct_to_hmi, bootstrap=True)
-    print("\tWeighted Census Tract Mean HMI: {0} [{1}-{2}]".format(hmi_stats['mean_hmi_w'],
-                                                                   hmi_stats['LB_hmi_w'],
-                                                                   hmi_stats['UB_hmi_w']))
+    entropy = compute_entropy(ct_entropy)
+    hmi_stats = compute_hmi(ct_entropy, ct_to_hmi, bootstrap=True, num_iter=num_iter, seed=seed, verbose=verbose)
+    if verbose:
+        print("\t{0} lines processed and {1} failed and {2} skipped.".format(lines_processed, lines_failed,
+                                                                          lines_skipped))
+        print("\tCensus Tract entropy: {0}".format(entropy))
+        print("\tWeighted Census Tract Mean HMI: {0} [{1}-{2}]".format(hmi_stats['mean_hmi_w'],
+                                                                       hmi_stats['LB_hmi_w'],
+                                                                       hmi_stats['UB_hmi_w']))
+    return {'input_fn': fn, 'lines_processed': lines_processed, 'lines_failed': lines_failed,
+            'lines_skipped': lines_skipped, 'entropy': entropy, 'mean_hmi_w': hmi_stats['mean_hmi_w'],
+            'LB_hmi_w': hmi_stats['LB_hmi_w'], 'UB_hmi_w': hmi_stats['UB_hmi_w']}
+
+
+def get_city_lookups(city):
+    """Load grid cell -> census tract and census tract -> HMI lookups for a city."""
+    rc_to_ct = get_grid_ct_raster(fn='geometries/{0}_ct_grid.csv'.format(city))
+    ct_to_hmi = get_hmi_mapping(censusfn='geometries/{0}_ct_census.csv'.format(city),
+                                geojsonfn="geometries/{0}_ct.geojson".format(city))
+    return rc_to_ct, ct_to_hmi
+
+
+def process_file(input_fn, rc_to_ct, ct_to_hmi, num_iter=1000, seed=None, verbose=True):
+    """Compute HMI stats for a CSV of routes or GeoJSON of significantly different route segments.
+
+    Returns:
+        stats: dictionary of HMI stats or None if the file is neither a CSV nor GeoJSON
+    """
+    if 'geojson' in input_fn:
+        if verbose:
+            print("Computing geojson-based HMI stats for {0}".format(input_fn))
+        return ct_stats_geojson(input_fn, rc_to_ct, ct_to_hmi, verbose=verbose)
+    elif 'csv' in input_fn:
+        if verbose:
+            print("Computing csv-based HMI stats for {0}".format(input_fn))
+        return ct_stats_csv(input_fn, rc_to_ct, ct_to_hmi, diffonly=True, num_iter=num_iter, seed=seed,
+                            verbose=verbose)
+    return None
+
+
+# Lookups for the city being processed by a worker process. Set once per worker by init_worker so that they are not
+# pickled and sent along with every file.
+_worker_lookups = {}
+
+
+def init_worker(rc_to_ct, ct_to_hmi, baseline_indices):
+    _worker_lookups['rc_to_ct'] = rc_to_ct
+    _worker_lookups['ct_to_hmi'] = ct_to_hmi
+    _baseline_indices.update(baseline_indices)
+
+
+def process_file_in_worker(task):
+    input_fn, num_iter, seed = task
+    try:
+        return process_file(input_fn, _worker_lookups['rc_to_ct'], _worker_lookups['ct_to_hmi'],
+                            num_iter=num_iter, seed=seed, verbose=False)
+    except Exception:
+        traceback.print_exc()
+        return {'input_fn': input_fn, 'error': traceback.format_exc(limit=1).strip()}
+
+
+def write_summary(results, summary_fn):
+    """Write HMI stats for all input files to a single JSON or CSV file (based on the file extension)."""
+    if summary_fn.endswith(".json"):
+        with open(summary_fn, 'w') as fout:
+            json.dump(results, fout, indent=2)
+    else:
+        fieldnames = []
+        for stats in results:
+            fieldnames.extend([k for k in stats if k not in fieldnames])
+        with open(summary_fn, 'w') as fout:
+            csvwriter = csv.DictWriter(fout, fieldnames=fieldnames)
+            csvwriter.writeheader()
+            for stats in results:
+                csvwriter.writerow(stats)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_fns", nargs="+", default=[],
                         help="CSVs (all routes) or GeoJSONs (significantly different routes from baseline) to process")
+    parser.add_argument("--num_iter", type=int, default=1000,
+                        help="Number of iterations to use in bootstrapping weighted HMI")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for bootstrapping so that results can be reproduced")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes across which to spread the input files")
+    parser.add_argument("--summary", default=None,
+                        help="Path to CSV or JSON file to which HMI stats for all input files are written")
     args = parser.parse_args()
 
     # If folder is given, include all of the files in that folder
@@ -417,25 +879,39 @@ def main():
         args.input_fns.extend(files)
     print("Processing:", args.input_fns)
 
-    prev_city = None
+    # Group files by city (preserving order) so that each city's lookups are only loaded once
+    files_by_city = {}
     for input_fn in args.input_fns:
         city = get_city(input_fn)
-        if not city:
-            continue
-        if city != prev_city:
-            prev_city = city
-            if city == "nyc":
-                rc_to_ct = get_grid_ct_dict(fn='geometries/nyc_ct_grid.csv')
-                ct_to_hmi = get_hmi_mapping(censusfn='geometries/nyc_ct_census.csv', geojsonfn="geometries/nyc_ct.geojson")
-            elif city == "sf":
-                rc_to_ct = get_grid_ct_dict(fn='geometries/sf_ct_grid.csv')
-                ct_to_hmi = get_hmi_mapping(censusfn='geometries/sf_ct_census.csv', geojsonfn="geometries/sf_ct.geojson")
-        if 'geojson' in input_fn:
-            print("Computing geojson-based HMI stats for {0}".format(input_fn))
-            ct_stats_geojson(input_fn, rc_to_ct, ct_to_hmi)
-        elif 'csv' in input_fn:
-            print("Computing csv-based HMI stats for {0}".format(input_fn))
-            ct_stats_csv(input_fn, rc_to_ct, ct_to_hmi, diffonly=True)
+        if city:
+            files_by_city.setdefault(city, []).append(input_fn)
+
+    results = []
+    for city in files_by_city:
+        rc_to_ct, ct_to_hmi = get_city_lookups(city)
+        if args.workers > 1:
+            print("Computing HMI stats for {0} {1} files with {2} workers".format(len(files_by_city[city]), city,
+                                                                                 args.workers))
+            tasks = [(input_fn, args.num_iter, args.seed) for input_fn in files_by_city[city]]
+            # load each baseline once here rather than once per worker
+            for input_fn in files_by_city[city]:
+                if 'csv' in input_fn and 'geojson' not in input_fn:
+                    get_baseline_index(city, get_routetype(input_fn))
+            with Pool(processes=args.workers, initializer=init_worker,
+                      initargs=(rc_to_ct, ct_to_hmi, _baseline_indices)) as pool:
+                for stats in pool.imap(process_file_in_worker, tasks):
+                    if stats:
+                        print("\tFinished {0}".format(stats['input_fn']))
+                        results.append(stats)
+        else:
+            for input_fn in files_by_city[city]:
+                stats = process_file(input_fn, rc_to_ct, ct_to_hmi, num_iter=args.num_iter, seed=args.seed)
+                if stats:
+                    results.append(stats)
+
+    if args.summary:
+        write_summary(results, args.summary)
+        print("HMI stats for {0} files written to {1}".format(len(results), args.summary))
 
 
 if __name__ == "__main__":
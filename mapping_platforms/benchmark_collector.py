@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Benchmark the concurrent route collector against the local stand-in server.
+
+Runs get_routes.collect_routes_concurrently for synthetic od-pairs against standin_server.py and reports the
+throughput (requests/sec), tail latency, failed requests, and how closely each platform's request rate stayed within
+the configured rate limits. Attempts at the server are reported alongside requests, as the API clients retry some
+errors before a request fails. Useful for tuning --google_rate, --mapquest_rate, and --max_in_flight without spending
+quota.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import numpy
+
+from get_routes import GoogleAPI, MapquestAPI, RouteWriter, TokenBucket, collect_routes_concurrently
+from standin_server import StandinConfig, start_server
+
+
+def synthetic_od_pairs(num_pairs, center=(40.75, -73.98), spread=0.1, seed=None):
+    rng = random.Random(seed)
+    od_pairs = []
+    for i in range(0, num_pairs):
+        origin = (round(center[0] + rng.uniform(-spread, spread), 6), round(center[1] + rng.uniform(-spread, spread), 6))
+        destination = (round(center[0] + rng.uniform(-spread, spread), 6),
+                       round(center[1] + rng.uniform(-spread, spread), 6))
+        od_pairs.append({'id': str(i), 'origin': origin, 'destination': destination})
+    return od_pairs
+
+
+def time_requests(api, timings):
+    """Record the (start, end) time of each get_routes call of api in timings."""
+    get_routes = api.get_routes
+
+    def timed_get_routes(origin, destination, route_id):
+        start = time.monotonic()
+        routes = get_routes(origin, destination, route_id)
+        timings.append((start, time.monotonic()))
+        return routes
+    api.get_routes = timed_get_routes
+
+
+def run_benchmark(num_pairs=200, google_rate=10, mapquest_rate=10, max_in_flight=4, output_num=2,
+                  standin_config=None, seed=None):
+    """Collect routes for synthetic od-pairs from the stand-in server.
+
+    Returns:
+        results: dictionary of benchmark stats for each platform
+    """
+    if standin_config is None:
+        standin_config = StandinConfig(seed=seed)
+    server = start_server(standin_config)
+    host = "http://{0}:{1}".format(*server.server_address)
+    od_pairs = synthetic_od_pairs(num_pairs, seed=seed)
+
+    cwd = os.getcwd()
+    # API logs, keys, and routes are written relative to the working directory and removed after the run
+    with tempfile.TemporaryDirectory(prefix="collector_benchmark_") as workdir:
+        os.chdir(workdir)
+        try:
+            os.mkdir("logs")
+            with open("google_key.txt", 'w') as fout:
+                fout.write("AIzaStandinKey\n")  # googlemaps checks for the prefix of a valid key
+            with open("mapquest_key.txt", 'w') as fout:
+                fout.write("standin\n")
+            g = GoogleAPI("google_key.txt", api_limit=num_pairs, city="benchmark", output_num=output_num, host=host)
+            m = MapquestAPI("mapquest_key.txt", api_limit=num_pairs, city="benchmark", output_num=output_num,
+                            host=host, pool_size=max_in_flight)
+            timings = {'google': [], 'mapquest': []}
+            time_requests(g, timings['google'])
+            time_requests(m, timings['mapquest'])
+            writer_g = RouteWriter("google_routes.csv")
+            writer_m = RouteWriter("mapquest_routes.csv")
+            providers = [(g, writer_g, TokenBucket(google_rate)), (m, writer_m, TokenBucket(mapquest_rate))]
+            start_time = datetime.datetime.now(datetime.timezone.utc)
+
+            start = time.monotonic()
+            asyncio.run(collect_routes_concurrently(od_pairs, providers, start_time, max_in_flight=max_in_flight))
+            elapsed = time.monotonic() - start
+            writer_g.close()
+            writer_m.close()
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+    results = {}
+    for api, rate in [(g, google_rate), (m, mapquest_rate)]:
+        platform_timings = numpy.array(timings[api.platform]).reshape(-1, 2)
+        platform_latencies = platform_timings[:, 1] - platform_timings[:, 0]
+        # each platform's throughput is over its own first to last request rather than the whole run, as a platform
+        # that finishes early would otherwise be reported at the slower platform's rate
+        if len(platform_timings):
+            platform_elapsed = platform_timings[:, 1].max() - platform_timings[:, 0].min()
+        else:
+            platform_elapsed = 0
+        # the googlemaps client retries OVER_QUERY_LIMIT and server errors itself, so count every attempt that reached
+        # the stand-in server
+        attempts = len(server.stats.request_times[api.platform])
+        rate_limit = standin_config.rate_limits[api.platform]
+        results[api.platform] = {
+            'requests': len(platform_latencies),
+            'attempts': attempts,
+            'retries': max(0, attempts - len(platform_latencies)),
+            'elapsed_sec': platform_elapsed,
+            'requests_per_sec': len(platform_latencies) / platform_elapsed if platform_elapsed else 0,
+            'p50_latency': numpy.percentile(platform_latencies, 50),
+            'p95_latency': numpy.percentile(platform_latencies, 95),
+            'p99_latency': numpy.percentile(platform_latencies, 99),
+            'failed': api.exceptions,
+            'server_errors': server.stats.errors[api.platform],
+            'rate_limited': server.stats.rate_limited[api.platform],
+            'target_rate': rate,
+            'server_rate_limit': rate_limit,
+            'max_requests_in_one_sec': server.stats.max_per_second(api.platform)}
+    results['elapsed_sec'] = elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_pairs", type=int, default=200, help="Number of synthetic od-pairs to collect")
+    parser.add_argument("--google_rate", type=float, default=10, help="Google requests per second for the collector")
+    parser.add_argument("--mapquest_rate", type=float, default=10, help="Mapquest requests per second for the collector")
+    parser.add_argument("--max_in_flight", type=int, default=4, help="Max requests awaiting a response per API")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean stand-in server latency in seconds")
+    parser.add_argument("--latency_jitter", type=float, default=0.05, help="Stand-in server latency jitter in seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of stand-in requests that fail")
+    parser.add_argument("--google_rate_limit", type=float, default=None, help="Stand-in Google requests per second")
+    parser.add_argument("--mapquest_rate_limit", type=float, default=None, help="Stand-in Mapquest requests per second")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    standin_config = StandinConfig(latency=args.latency, latency_jitter=args.latency_jitter,
+                                   error_rate=args.error_rate, google_rate_limit=args.google_rate_limit,
+                                   mapquest_rate_limit=args.mapquest_rate_limit, seed=args.seed)
+    results = run_benchmark(num_pairs=args.num_pairs, google_rate=args.google_rate,
+                            mapquest_rate=args.mapquest_rate, max_in_flight=args.max_in_flight,
+                            standin_config=standin_config, seed=args.seed)
+
+    print("{0} od-pairs collected in {1:.2f} seconds.".format(args.num_pairs, results['elapsed_sec']))
+    for platform in ['google', 'mapquest']:
+        stats = results[platform]
+        print("{0}: {1} requests in {2:.2f} seconds ({3:.2f} requests/sec). Latency p50 {4:.3f}s, p95 {5:.3f}s, "
+              "p99 {6:.3f}s.".format(platform, stats['requests'], stats['elapsed_sec'], stats['requests_per_sec'],
+                                     stats['p50_latency'], stats['p95_latency'], stats['p99_latency']))
+        print("\t{0} attempts at the server ({1} retries). {2} failed ({3} server errors, {4} rate limited).".format(
+            stats['attempts'], stats['retries'], stats['failed'], stats['server_errors'], stats['rate_limited']))
+        print("\tMax requests in one second: {0} (collector rate {1}, server limit {2}).".format(
+            stats['max_requests_in_one_sec'], stats['target_rate'], stats['server_rate_limit']))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,27 +8,118 @@ set so that gathering time of routes is carefully controlled.
 """
 from abc import ABCMeta, abstractmethod
 
+import os
 import csv
 import argparse
 import time
 import json
-import ast
 import traceback
-import urllib.parse
-import urllib.request
-import argparse
 import datetime
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from random import random
 from time import strftime
 
 import googlemaps
+import numpy
+import requests
+
+from response_cache import ResponseCache
+
+
+def decode_polylines(point_strs, groups=None, return_index=False):
+    """Decode polylines that have been encoded using Google's algorithm into a single array of points.
+
+    All characters of all polylines are decoded at once with numpy rather than one at a time.
+    http://code.google.com/apis/maps/documentation/polylinealgorithm.html
+
+    Args:
+        point_strs: list of encoded polyline strings (e.g. the steps of a route)
+        groups: optional label (e.g. route index) for each polyline. If the first point of a polyline duplicates the
+            last point of the previous polyline in the same group, it is dropped. By default, all polylines are one
+            group so that the steps of a route are joined together.
+        return_index: True if the index of the polyline that each point came from should also be returned
+    Returns:
+        points: (N, 2) array of (latitude, longitude)
+        polyline_idx: (N,) array of indices into point_strs, if return_index
+    """
+    nonempty = [i for i in range(0, len(point_strs)) if point_strs[i]]
+    if not nonempty:
+        points = numpy.empty((0, 2))
+        return (points, numpy.empty(0, dtype=numpy.int64)) if return_index else points
+
+    chars = numpy.frombuffer("".join(point_strs[i] for i in nonempty).encode('ascii'), dtype=numpy.uint8)
+    values = chars.astype(numpy.int64) - 63
+    # each coordinate offset is split into 5-bit chunks; all but the last chunk have the 0x20 bit set
+    last_chunk = (values & 0x20) == 0
+    value_starts = numpy.concatenate(([0], numpy.flatnonzero(last_chunk)[:-1] + 1))
+    value_ids = numpy.cumsum(last_chunk) - last_chunk
+    chunk_positions = numpy.arange(len(values)) - value_starts[value_ids]
+    offsets = numpy.add.reduceat((values & 0x1F) << (5 * chunk_positions), value_starts)
+    # there is a 1 on the right if the offset is negative
+    offsets = numpy.where(offsets & 0x1, ~offsets, offsets) >> 1
+
+    # offsets alternate latitude, longitude and restart from zero at the start of each polyline
+    str_lengths = numpy.array([len(point_strs[i]) for i in nonempty])
+    values_per_str = numpy.add.reduceat(last_chunk, numpy.concatenate(([0], numpy.cumsum(str_lengths)[:-1])))
+    if numpy.any(values_per_str % 2):
+        raise ValueError("Polyline has an odd number of coordinates")
+    offsets = offsets.reshape(-1, 2)
+    points_per_str = values_per_str // 2
+    str_ids = numpy.repeat(numpy.arange(len(nonempty)), points_per_str)
+    totals = numpy.cumsum(offsets, axis=0)
+    str_starts = numpy.concatenate(([0], numpy.cumsum(points_per_str)[:-1]))
+    coords = totals - (totals[str_starts] - offsets[str_starts])[str_ids]
+
+    # points with no offset from the previous point are skipped
+    keep = (offsets[:, 0] != 0) | (offsets[:, 1] != 0)
+    coords = coords[keep]
+    polyline_idx = numpy.array(nonempty)[str_ids[keep]]
+    # check if first point duplicates last point from previous polyline of the same group
+    duplicate = numpy.zeros(len(coords), dtype=bool)
+    duplicate[1:] = ((polyline_idx[1:] != polyline_idx[:-1]) &
+                     (coords[1:, 0] == coords[:-1, 0]) & (coords[1:, 1] == coords[:-1, 1]))
+    if groups is not None:
+        group_ids = numpy.unique(numpy.asarray(groups), return_inverse=True)[1].ravel()[polyline_idx]
+        duplicate[1:] &= group_ids[1:] == group_ids[:-1]
+    points = coords[~duplicate] / 100000.0
+    if return_index:
+        return points, polyline_idx[~duplicate]
+    return points
+
+
+def encode_polyline(points):
+    """Encode (latitude, longitude) points using Google's polyline algorithm.
+
+    Args:
+        points: list or (N, 2) array of (latitude, longitude)
+    Returns:
+        Encoded polyline string that decode_polylines turns back into points (to 5 decimal places)
+    """
+    coords = numpy.round(numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2) * 100000).astype(numpy.int64)
+    offsets = numpy.diff(coords, axis=0, prepend=numpy.zeros((1, 2), dtype=numpy.int64)).ravel()
+    offsets = numpy.where(offsets < 0, ~(offsets << 1), offsets << 1)
+    # split each offset into 5-bit chunks (at most 7 for 32-bit coordinates), setting 0x20 on all but the last
+    chunks = numpy.stack([(offsets >> (5 * i)) & 0x1F for i in range(0, 7)], axis=1)
+    remaining = numpy.stack([offsets >> (5 * i) for i in range(1, 8)], axis=1)
+    present = numpy.ones(chunks.shape, dtype=bool)
+    present[:, 1:] = remaining[:, :-1] > 0
+    chars = chunks + 63 + numpy.where(remaining > 0, 0x20, 0)
+    return chars[present].astype(numpy.uint8).tobytes().decode('ascii')
+
 
 class API(object, metaclass = ABCMeta):
 
-    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1):
-        with open(api_key_fn, 'r') as keyfile:
-            self.api_key = next(keyfile).strip()
+    platform = None
+    default_host = None
+
+    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1, host=None):
+        # no API key is needed if only replaying cached responses (see use_response_cache)
+        self.api_key = None
+        if api_key_fn is not None:
+            with open(api_key_fn, 'r') as keyfile:
+                self.api_key = next(keyfile).strip()
         self.api_limit = api_limit
         self.stop_at_api_limit = stop_at_api_limit
         if output_num > 1:
@@ -37,8 +128,13 @@ class API(object, metaclass = ABCMeta):
             self.get_alternatives = False
         self.output_num = output_num
         self.logfile_fn = "logs/{0}_{1}_PLATFORM_log.txt".format(city, route_type)
+        # scheme + host that requests are sent to (e.g. a local stand-in server for testing)
+        self.host = host or self.default_host
         self.queries_made = 0
         self.exceptions = 0
+        self.response_cache = None
+        self.replay = False
+        self.replay_departure_time = None
 
     @classmethod
     @abstractmethod
@@ -47,6 +143,31 @@ class API(object, metaclass = ABCMeta):
         return [Route()]
 
 
+    @abstractmethod
+    def query_api(self, origin, destination):
+        """Query the API for an od-pair and return the raw (JSON-compatible) response."""
+        return {}
+
+    def use_response_cache(self, response_cache, replay=False, departure_time=None):
+        """Store all responses in response_cache. If replay, answer queries only from the cache (no network access)
+        with the responses collected in the departure-time bucket of departure_time (seconds since the epoch) or the
+        most recently collected responses if departure_time is None."""
+        self.response_cache = response_cache
+        self.replay = replay
+        self.replay_departure_time = departure_time
+
+    def get_response(self, origin, destination):
+        if self.replay:
+            response = self.response_cache.get(self.platform, origin, destination, self.output_num,
+                                               departure_time=self.replay_departure_time)
+            if response is None:
+                raise LookupError("No cached response from {0} to {1}".format(origin, destination))
+            return response
+        response = self.query_api(origin, destination)
+        if self.response_cache is not None:
+            self.response_cache.put(self.platform, origin, destination, self.output_num, response)
+        return response
+
     def write_to_log(self, mess_type="LOG", message=""):
         with open(self.logfile_fn, 'a') as fout:
             fout.write("{0}: At {1}: {2}. {3} queries made.\n".format(mess_type, strftime("%Y-%m-%d %H:%M:%S"), message, self.queries_made))
@@ -60,6 +181,12 @@ class API(object, metaclass = ABCMeta):
         self.write_to_log("RESET", "Returned counts to zero")
 
 
+# standard time UTC offset of each city - must adjust after Daylight Savings Time
+UTC_ZONES = {'sf':-8, 'nyc':-5, 'lon':0, 'man':8, 'sin':8}
+
+ROUTE_FIELDNAMES = ['ID', 'name', 'polyline_points', 'total_time_in_sec', 'total_distance_in_meters', 'number_of_steps', 'maneuvers']
+
+
 class Route(dict):
 
     def __init__(self, route_id="", name="", route_points=[], time_sec=None, distance_meters=None, maneuvers=[]):
@@ -72,21 +199,82 @@ class Route(dict):
         self['number_of_steps'] = len(maneuvers)
         
 
+class RouteWriter(object):
+    """Buffered CSV writer for routes that keeps track of which od-pairs have been completed.
+
+    Rows are written out in batches every flush_interval seconds. The IDs of completed od-pairs are appended to a
+    checkpoint file alongside the routes each time they are flushed so that an interrupted run can be resumed
+    without querying those od-pairs again.
+    """
+
+    def __init__(self, routes_fn, resume=False, flush_interval=30):
+        self.routes_fn = routes_fn
+        self.checkpoint_fn = routes_fn.replace(".csv", "_done.txt")
+        self.flush_interval = flush_interval
+        self.done = set()
+        if resume and os.path.isfile(routes_fn):
+            if os.path.isfile(self.checkpoint_fn):
+                with open(self.checkpoint_fn, 'r') as fin:
+                    self.done = set(line.strip() for line in fin if line.strip())
+            self.fout = open(routes_fn, 'a')
+            self.csvwriter = csv.DictWriter(self.fout, fieldnames=ROUTE_FIELDNAMES)
+        else:
+            self.fout = open(routes_fn, 'w')
+            self.csvwriter = csv.DictWriter(self.fout, fieldnames=ROUTE_FIELDNAMES)
+            self.csvwriter.writeheader()
+            open(self.checkpoint_fn, 'w').close()
+        self.pending_routes = []
+        self.pending_ids = []
+        self.last_flush = time.monotonic()
+
+    def is_done(self, route_id):
+        return route_id in self.done
+
+    def write_routes(self, route_id, routes):
+        """Queue routes for an od-pair. Failed queries (routes without an ID) are written but not marked complete."""
+        self.pending_routes.extend(routes)
+        if all(route['ID'] for route in routes):
+            self.pending_ids.append(route_id)
+            self.done.add(route_id)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.csvwriter.writerows(self.pending_routes)
+        self.fout.flush()
+        # routes are on disk before their od-pairs are marked complete
+        with open(self.checkpoint_fn, 'a') as fout:
+            for route_id in self.pending_ids:
+                fout.write("{0}\n".format(route_id))
+        self.pending_routes = []
+        self.pending_ids = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.fout.close()
+
+
 class GoogleAPI(API):
 
-    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1):
-        super().__init__(api_key_fn, api_limit, stop_at_api_limit, city, route_type, output_num)
+    platform = "google"
+    default_host = "https://maps.googleapis.com"
+
+    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1, host=None):
+        super().__init__(api_key_fn, api_limit, stop_at_api_limit, city, route_type, output_num, host)
         self.logfile_fn = self.logfile_fn.replace("PLATFORM", "google")
         self.write_to_log("START", "Starting Google API")
         self.client = None
 
-    def get_routes(self, origin, destination, route_id):
+    def query_api(self, origin, destination):
         if not self.client:
             self.connect_to_api()
+        return self.client.directions(origin = origin, destination = destination, units = "metric", mode = "driving", departure_time = "now", alternatives = self.get_alternatives)
 
+    def get_routes(self, origin, destination, route_id):
         routes = []
         try:
-            route_jsons = self.client.directions(origin = origin, destination = destination, units = "metric", mode = "driving", departure_time = "now", alternatives = self.get_alternatives)
+            route_jsons = self.get_response(origin, destination)
 
         except Exception:
             traceback.print_exc()
@@ -104,14 +292,9 @@ class GoogleAPI(API):
                 # overviewPolylinePoints = route_json.get('overview_polyline').get('points')
                 # instead, we take the least-smoothed version at the step-level
                 route_steps = route.get('steps')
-                route_points = []
-                for step in route_steps:
-                    polyline_str = step.get("polyline", {"points":""}).get("points")
-                    polyline_pts = self.decode(polyline_str)
-                    # check if first point duplicates last point from previous step
-                    if polyline_pts and route_points and polyline_pts[0] == route_points[-1]:
-                        polyline_pts.pop(0)
-                    route_points.extend(polyline_pts)
+                route_points = decode_polylines([step.get("polyline", {"points":""}).get("points")
+                                                 for step in route_steps])
+                route_points = list(map(tuple, route_points.tolist()))
 
                 total_time_sec = route.get('duration').get('value')
                 total_distance_meters = route.get('distance').get('value')
@@ -143,7 +326,7 @@ class GoogleAPI(API):
     
     def connect_to_api(self):
         # ValueError if invalid API-Key
-        self.client = googlemaps.Client(key=self.api_key)
+        self.client = googlemaps.Client(key=self.api_key, base_url=self.host)
 
 
     def decode(self, point_str):
@@ -151,9 +334,7 @@ class GoogleAPI(API):
         http://code.google.com/apis/maps/documentation/polylinealgorithm.html
 
         This is a generic method that returns a list of (latitude, longitude)
-        tuples.
-
-        Code taken from: https://gist.github.com/signed0/2031157
+        tuples. See decode_polylines for decoding many polylines at once.
 
         :param point_str: Encoded polyline string.
         :type point_str: string
@@ -161,85 +342,58 @@ class GoogleAPI(API):
         :rtype: list
 
         '''
-
-        # sone coordinate offset is represented by 4 to 5 binary chunks
-        coord_chunks = [[]]
-        for char in point_str:
-
-            # convert each character to decimal from ascii
-            value = ord(char) - 63
-
-            # values that have a chunk following have an extra 1 on the left
-            split_after = not (value & 0x20)
-            value &= 0x1F
-
-            coord_chunks[-1].append(value)
-
-            if split_after:
-                coord_chunks.append([])
-
-        del coord_chunks[-1]
-
-        coords = []
-
-        for coord_chunk in coord_chunks:
-            coord = 0
-
-            for i, chunk in enumerate(coord_chunk):
-                coord |= chunk << (i * 5)
-
-            #there is a 1 on the right if the coord is negative
-            if coord & 0x1:
-                coord = ~coord #invert
-            coord >>= 1
-            coord /= 100000.0
-
-            coords.append(coord)
-
-        # convert the 1 dimensional list to a 2 dimensional list and offsets to
-        # actual values
-        points = []
-        prev_x = 0
-        prev_y = 0
-        for i in range(0, len(coords) - 1, 2):
-            if coords[i] == 0 and coords[i + 1] == 0:
-                continue
-
-            prev_x += coords[i + 1]
-            prev_y += coords[i]
-            # a round to 6 digits ensures that the floats are the same as when
-            # they were encoded
-            points.append((round(prev_y, 6), round(prev_x, 6)))
-
-        return points
+        return list(map(tuple, decode_polylines([point_str]).tolist()))
 
 
 class MapquestAPI(API):
 
+    platform = "mapquest"
+    default_host = "http://www.mapquestapi.com"
+
     _turn_types = ['straight', 'slight right', 'right', 'sharp right', 'reverse', 'sharp left', 'left', 'slight left', 'right u-turn', 'left u-turn', 'right merge', 'left merge', 'right on ramp', 'left on ramp', 'right off ramp', 'left off ramp', 'right fork', 'left fork', 'straight fork', 'take transit', 'transfer transit', 'port transit', 'enter transit', 'exit transit']
 
-    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1):
-        super().__init__(api_key_fn, api_limit, stop_at_api_limit, city, route_type, output_num)
+    def __init__(self, api_key_fn, api_limit=2500, stop_at_api_limit=True, city="nyc", route_type="grid", output_num=1, host=None, pool_size=10, timeout=30):
+        """
+        Args:
+            pool_size: number of keep-alive connections to keep open (should be at least the number of requests in
+                flight at once when collecting concurrently)
+            timeout: seconds to wait for a connection or response before the query fails
+        """
+        super().__init__(api_key_fn, api_limit, stop_at_api_limit, city, route_type, output_num, host)
         self.logfile_fn = self.logfile_fn.replace("PLATFORM", "mapquest")
         self.write_to_log("LOG", "Starting Mapquest API")
         if self.get_alternatives:
-            self.base_url = "http://www.mapquestapi.com/directions/v2/alternateroutes?"
+            self.base_url = self.host + "/directions/v2/alternateroutes"
         else:
-            self.base_url = "http://www.mapquestapi.com/directions/v2/route?"
-
-    def get_routes(self, origin, destination, route_id):
-        routes = []
+            self.base_url = self.host + "/directions/v2/route"
+        self.timeout = timeout
+        self.session = None
+        if self.api_key is not None:
+            self.connect_to_api(pool_size)
+
+    def connect_to_api(self, pool_size):
+        # connections are reused across queries (and threads) rather than opening a new one for each request
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def query_api(self, origin, destination):
         start = "{0},{1}".format(origin[0], origin[1])
         dest = "{0},{1}".format(destination[0], destination[1])
+        params = [('key', self.api_key), ("from", start), ("to", dest), ('narrativeType', 'text'), ('fullShape', 'true'), ('routeType', 'fastest'), ('unit', 'k'), ('doReverseGeocode','false')]
         if self.get_alternatives:
-            url = self.base_url + urllib.parse.urlencode([('key', self.api_key), ("from", start), ("to", dest), ('narrativeType', 'text'), ('fullShape', 'true'), ('routeType', 'fastest'), ('unit', 'k'), ('doReverseGeocode','false'), ('maxRoutes', self.output_num)])
-        else:
-            url = self.base_url + urllib.parse.urlencode([('key', self.api_key), ("from", start), ("to", dest), ('narrativeType', 'text'), ('fullShape', 'true'), ('routeType', 'fastest'), ('unit', 'k'), ('doReverseGeocode','false')])      
+            params.append(('maxRoutes', self.output_num))
+        with self.session.get(self.base_url, params=params, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            # decode the JSON as it is streamed off of the connection
+            response.raw.decode_content = True
+            return json.load(response.raw)
 
+    def get_routes(self, origin, destination, route_id):
+        routes = []
         try:
-            response = urllib.request.urlopen(url)
-            response_str = response.read().decode('utf-8')
-            route_json = ast.literal_eval(response_str.replace('false','False').replace('true','True'))['route']
+            route_json = self.get_response(origin, destination)['route']
         except Exception:
             traceback.print_exc()
             self.exceptions += 1
@@ -269,10 +423,9 @@ class MapquestAPI(API):
 
     def process_route(self, route_id, route_json, name):
         route_steps = route_json.get('legs')[0].get('maneuvers')
-        route_points_raw = route_json.get('shape')['shapePoints']
-        route_points = []
-        for i in range(0, len(route_points_raw), 2):
-            route_points.append((route_points_raw[i], route_points_raw[i+1]))
+        # shapePoints alternates latitude, longitude
+        route_points = numpy.asarray(route_json.get('shape')['shapePoints'], dtype=numpy.float64).reshape(-1, 2)
+        route_points = list(map(tuple, route_points.tolist()))
 
         total_time_sec = route_json.get('realTime')
         if total_time_sec > 10000000:  # used by mapquest to signify closed road
@@ -284,7 +437,7 @@ class MapquestAPI(API):
             try:
                 maneuvers.append(self._turn_types[route_steps[i].get('turnType')])
             except IndexError:
-                self.write_to_log("EXCEPTION", "{0}: illegal maneuver {1}".format(row[id_idx], route_steps[i]))
+                self.write_to_log("EXCEPTION", "{0}: illegal maneuver {1}".format(route_id, route_steps[i]))
                 maneuvers.append(None)
         num_steps = len(maneuvers) - 1  # don't count first step
         return Route(route_id=route_id, name=name, route_points=route_points, time_sec=total_time_sec, distance_meters=total_distance_meters, maneuvers=maneuvers)
@@ -292,31 +445,41 @@ class MapquestAPI(API):
 
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("city", help="City to run grid analysis for: 'sf' or 'nyc'")
-    parser.add_argument("start_time", type=int, help="## between 00 and 24")
-    parser.add_argument("--current_utc_offset", type=int, default=-6, help="UTC zone for where script is being run (e.g. -6 is Chicago)")
-    args = parser.parse_args()
+class TokenBucket(object):
+    """Rate limiter for asyncio allowing a steady rate of requests with short bursts.
 
-    utczones = {'sf':-8, 'nyc':-5, 'lon':0, 'man':8, 'sin':8}
+    Tokens are added at `rate` per second up to `capacity` and each request consumes one token.
+    """
 
-    # Time in Chicago during winter - must adjust after Daylight Savings Time
-    current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=args.current_utc_offset)))
-    try:
-        utc_zone = utczones.get(args.city)
-    except KeyError:
-        print("Invalid city. Must be one of {0}.".format(utczones.keys()))
-        return
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = None
 
-    start_time = datetime.datetime(year = current_time.year, month = current_time.month, day = current_time.day, hour=args.start_time, tzinfo = datetime.timezone(datetime.timedelta(hours=utc_zone)))
-    sleep_for = (start_time - current_time).seconds
-    print("Will sleep for {0} seconds before starting.".format(sleep_for))
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    input_odpairs_fn = "data/intermediate/{0}_grid_od_pairs.csv".format(args.city)
-    output_routes_g_fn = "data/intermediate/{0}_grid_google_routes.csv".format(args.city)
-    output_routes_m_fn = "data/intermediate/{0}_grid_mapquest_routes.csv".format(args.city)
 
+def seconds_until(start_time):
+    """Seconds until the time of day of start_time next occurs (e.g. the start of tomorrow's collection window)."""
+    current_time = datetime.datetime.now(start_time.tzinfo)
+    return (start_time - current_time).seconds
+
+
+def load_od_pairs(input_odpairs_fn):
+    """Load origin-destination pairs as a list of {'id', 'origin', 'destination'} with (lat, lon) points."""
     od_pairs = []
     with open(input_odpairs_fn, 'r') as fin:
         # open file with origin long, origin lat, dest long, dest lat
@@ -328,66 +491,217 @@ def main():
         olt_idx = input_header.index("origin_lat")
         dln_idx = input_header.index("destination_lon")
         dlt_idx = input_header.index("destination_lat")
-        dist_idx = input_header.index("straight_line_distance")
         for row in csvreader:
             origin = float(row[olt_idx]), float(row[oln_idx])
             destination = float(row[dlt_idx]), float(row[dln_idx])
             route_id = row[id_idx]
             od_pairs.append({'id':route_id, 'origin':origin, 'destination':destination})
-                            
-    with open(output_routes_g_fn, 'w') as foutg:
-        with open(output_routes_m_fn, 'w') as foutm:
-            fieldnames = ['ID', 'name', 'polyline_points', 'total_time_in_sec', 'total_distance_in_meters', 'number_of_steps', 'maneuvers']
-            csvwriter_g = csv.DictWriter(foutg, fieldnames=fieldnames)
-            csvwriter_m = csv.DictWriter(foutm, fieldnames=fieldnames)
-            csvwriter_g.writeheader()
-            csvwriter_m.writeheader()
-            g = GoogleAPI(api_key_fn="api_keys/google.txt", api_limit=2500, stop_at_api_limit=True, city=args.city, route_type="grid", output_num=2)
-            m = MapquestAPI(api_key_fn="api_keys/mapquest.txt", api_limit=2500, stop_at_api_limit=True, city=args.city, route_type="grid", output_num=2)
-            
-            time.sleep(sleep_for)
-            g.write_to_log("LOG: At {0}: Starting script.\n".format(strftime("%Y-%m-%d %H:%M:%S")))
-            m.write_to_log("LOG: At {0}: Starting script.\n".format(strftime("%Y-%m-%d %H:%M:%S")))
-
-            for od_pair in od_pairs:
-                try:
-                    routes_g = g.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
-                    routes_m = m.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
-                    for route in routes_g:
-                        csvwriter_g.writerow(route)
-                    for route in routes_m:
-                        csvwriter_m.writerow(route)
-
-                    if (g.exceptions + 1) % 40 == 0 or (m.exceptions + 1) % 40 == 0:
-                        g.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format((g.exceptions, m.exceptions)))
-                        m.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format((g.exceptions, m.exceptions)))
-                        #break
-                            
-                    if g.queries_made % 500 == 0:
-                        g.write_to_log("LOG", "Every 500 query check")
-                        m.write_to_log("LOG", "Every 500 query check")
-                        
-                    # when almost hit API limit, shut-down
-                    if g.stop_at_api_limit and g.queries_made == g.api_limit:
-                        current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=-6)))
-                        sleep_for = (start_time - current_time).seconds
-                        g.write_to_log("API LIMIT", "Script sleeping for {0} seconds. Current route ID is {1}".format(sleep_for, od_pair['id']))
-                        m.write_to_log("API LIMIT", "Script sleeping for {0} seconds. Current route ID is {1}".format(sleep_for, od_pair['id']))
-                            
-                        time.sleep(sleep_for)
-                        g.reset()
-                        m.reset()
-                    else:
-                        # be nice to API
-                        time.sleep(1 + (0.5 - random()))
-                    
-
-                except KeyboardInterrupt:
-                    traceback.print_exc()
-                    break
-
-            g.end()
-            m.end()
+    return od_pairs
+
+
+async def collect_provider_routes(api, od_pairs, writer, rate_limiter, executor, start_time, max_in_flight=4):
+    """Get routes for all od-pairs from a single API, keeping up to max_in_flight requests going at once.
+
+    Od-pairs already completed by writer are skipped. Requests are spaced out by rate_limiter. When the API limit is reached, collection pauses until the start of the
+    next collection window (the time of day of start_time) so that routes are still gathered at comparable times.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def get_and_write(od_pair):
+        routes = await loop.run_in_executor(executor, api.get_routes, od_pair['origin'], od_pair['destination'],
+                                            od_pair['id'])
+        writer.write_routes(od_pair['id'], routes)
+        if api.queries_made and api.queries_made % 500 == 0:
+            api.write_to_log("LOG", "Every 500 query check")
+        if (api.exceptions + 1) % 40 == 0:
+            api.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached.".format(api.exceptions))
+
+    in_flight = set()
+    requests_issued = 0
+    for od_pair in od_pairs:
+        if writer.is_done(od_pair['id']):
+            continue
+        # when hit API limit, wait for the next collection window
+        if api.stop_at_api_limit and requests_issued == api.api_limit:
+            if in_flight:
+                await asyncio.wait(in_flight)
+                in_flight = set()
+            writer.flush()
+            sleep_for = seconds_until(start_time)
+            api.write_to_log("API LIMIT", "Sleeping for {0} seconds. Current route ID is {1}".format(sleep_for,
+                                                                                                   od_pair['id']))
+            await asyncio.sleep(sleep_for)
+            api.reset()
+            requests_issued = 0
+        while len(in_flight) >= max_in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        await rate_limiter.acquire()
+        requests_issued += 1
+        in_flight.add(asyncio.ensure_future(get_and_write(od_pair)))
+    if in_flight:
+        await asyncio.wait(in_flight)
+    writer.flush()
+    api.end()
+
+
+async def collect_routes_concurrently(od_pairs, providers, start_time, max_in_flight=4):
+    """Get routes for all od-pairs from all APIs at once.
+
+    Args:
+        od_pairs: list of od-pairs as returned by load_od_pairs
+        providers: list of (API, RouteWriter, TokenBucket) for each API to be queried
+        start_time: start of the daily collection window (timezone-aware datetime)
+        max_in_flight: maximum number of requests waiting on a response at once for each API
+    Returns:
+        Void. Writes routes to each API's RouteWriter.
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight * len(providers)) as executor:
+        await asyncio.gather(*[collect_provider_routes(api, od_pairs, writer, rate_limiter, executor,
+                                                       start_time, max_in_flight)
+                               for api, writer, rate_limiter in providers])
+
+
+def collect_routes_sequentially(od_pairs, g, m, writer_g, writer_m, start_time, pause=True):
+    """Get routes for all od-pairs from Google and then Mapquest one at a time, skipping completed od-pairs.
+
+    If pause, wait about a second between od-pairs to be nice to the APIs (not needed when replaying responses).
+    """
+    for od_pair in od_pairs:
+        if writer_g.is_done(od_pair['id']) and writer_m.is_done(od_pair['id']):
+            continue
+        try:
+            if not writer_g.is_done(od_pair['id']):
+                routes_g = g.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
+                writer_g.write_routes(od_pair['id'], routes_g)
+            if not writer_m.is_done(od_pair['id']):
+                routes_m = m.get_routes(od_pair['origin'], od_pair['destination'], od_pair['id'])
+                writer_m.write_routes(od_pair['id'], routes_m)
+
+            if (g.exceptions + 1) % 40 == 0 or (m.exceptions + 1) % 40 == 0:
+                g.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format((g.exceptions, m.exceptions)))
+                m.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached. Should be halting script".format((g.exceptions, m.exceptions)))
+                #break
+
+            if g.queries_made % 500 == 0:
+                g.write_to_log("LOG", "Every 500 query check")
+                m.write_to_log("LOG", "Every 500 query check")
+
+            # when almost hit API limit, shut-down
+            if g.stop_at_api_limit and g.queries_made == g.api_limit:
+                current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=-6)))
+                sleep_for = (start_time - current_time).seconds
+                g.write_to_log("API LIMIT", "Script sleeping for {0} seconds. Current route ID is {1}".format(sleep_for, od_pair['id']))
+                m.write_to_log("API LIMIT", "Script sleeping for {0} seconds. Current route ID is {1}".format(sleep_for, od_pair['id']))
+                writer_g.flush()
+                writer_m.flush()
+
+                time.sleep(sleep_for)
+                g.reset()
+                m.reset()
+            elif pause:
+                # be nice to API
+                time.sleep(1 + (0.5 - random()))
+
+
+        except KeyboardInterrupt:
+            traceback.print_exc()
+            break
+
+    g.end()
+    m.end()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("city", help="City to run grid analysis for: 'sf' or 'nyc'")
+    parser.add_argument("start_time", type=int, help="## between 00 and 24")
+    parser.add_argument("--current_utc_offset", type=int, default=-6, help="UTC zone for where script is being run (e.g. -6 is Chicago)")
+    parser.add_argument("--concurrent", action="store_true", help="Query Google and Mapquest at the same time with several requests in flight")
+    parser.add_argument("--google_rate", type=float, default=5, help="Max Google requests per second when concurrent")
+    parser.add_argument("--mapquest_rate", type=float, default=5, help="Max Mapquest requests per second when concurrent")
+    parser.add_argument("--max_in_flight", type=int, default=4, help="Max requests awaiting a response per API when concurrent")
+    parser.add_argument("--resume", action="store_true", help="Append to existing output and skip od-pairs already collected")
+    parser.add_argument("--flush_interval", type=float, default=30, help="Seconds between writing batches of routes to disk")
+    parser.add_argument("--response_cache", default=None, help="SQLite file in which to store raw API responses")
+    parser.add_argument("--replay", action="store_true", help="Process cached responses instead of querying the APIs (no network access or API keys)")
+    parser.add_argument("--departure_bucket", default=None, help="With --replay, process the responses collected in the departure-time bucket containing this time (e.g. 2017-02-03T08:00, in the city's time zone unless an offset is given). Default: the most recently collected response for each od-pair")
+    args = parser.parse_args()
+    if args.departure_bucket and not args.replay:
+        parser.error("--departure_bucket is only used with --replay")
+
+    # Time in Chicago during winter - must adjust after Daylight Savings Time
+    current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=args.current_utc_offset)))
+    try:
+        utc_zone = UTC_ZONES.get(args.city)
+    except KeyError:
+        print("Invalid city. Must be one of {0}.".format(UTC_ZONES.keys()))
+        return
+
+    start_time = datetime.datetime(year = current_time.year, month = current_time.month, day = current_time.day, hour=args.start_time, tzinfo = datetime.timezone(datetime.timedelta(hours=utc_zone)))
+    sleep_for = (start_time - current_time).seconds
+    if args.replay:
+        sleep_for = 0
+    print("Will sleep for {0} seconds before starting.".format(sleep_for))
+
+    input_odpairs_fn = "data/intermediate/{0}_grid_od_pairs.csv".format(args.city)
+    output_routes_g_fn = "data/intermediate/{0}_grid_google_routes.csv".format(args.city)
+    output_routes_m_fn = "data/intermediate/{0}_grid_mapquest_routes.csv".format(args.city)
+    response_cache = None
+    if args.replay:
+        # keep replayed routes separate from the originally collected routes
+        output_routes_g_fn = output_routes_g_fn.replace(".csv", "_replay.csv")
+        output_routes_m_fn = output_routes_m_fn.replace(".csv", "_replay.csv")
+        if not args.response_cache:
+            args.response_cache = "data/intermediate/{0}_grid_responses.sqlite".format(args.city)
+    if args.response_cache:
+        response_cache = ResponseCache(args.response_cache)
+    replay_departure_time = None
+    if args.departure_bucket:
+        departure = datetime.datetime.fromisoformat(args.departure_bucket)
+        if departure.tzinfo is None:
+            departure = departure.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=utc_zone)))
+        replay_departure_time = departure.timestamp()
+        bucket_start = response_cache.departure_bucket(replay_departure_time) * response_cache.bucket_seconds
+        print("Replaying responses collected between {0} and {1}.".format(
+            datetime.datetime.fromtimestamp(bucket_start, departure.tzinfo),
+            datetime.datetime.fromtimestamp(bucket_start + response_cache.bucket_seconds, departure.tzinfo)))
+    elif args.replay:
+        print("Replaying the most recently collected response for each od-pair.")
+
+    od_pairs = load_od_pairs(input_odpairs_fn)
+
+    writer_g = RouteWriter(output_routes_g_fn, resume=args.resume, flush_interval=args.flush_interval)
+    writer_m = RouteWriter(output_routes_m_fn, resume=args.resume, flush_interval=args.flush_interval)
+    if args.resume:
+        print("Resuming: {0} Google and {1} Mapquest od-pairs already collected.".format(len(writer_g.done),
+                                                                                       len(writer_m.done)))
+    try:
+        # replaying only reads from the response cache so no API keys or clients are needed
+        g = GoogleAPI(api_key_fn=None if args.replay else "api_keys/google.txt", api_limit=2500, stop_at_api_limit=not args.replay, city=args.city, route_type="grid", output_num=2)
+        m = MapquestAPI(api_key_fn=None if args.replay else "api_keys/mapquest.txt", api_limit=2500, stop_at_api_limit=not args.replay, city=args.city, route_type="grid", output_num=2, pool_size=args.max_in_flight)
+        if response_cache is not None:
+            g.use_response_cache(response_cache, replay=args.replay, departure_time=replay_departure_time)
+            m.use_response_cache(response_cache, replay=args.replay, departure_time=replay_departure_time)
+
+        time.sleep(sleep_for)
+        g.write_to_log("LOG: At {0}: Starting script.\n".format(strftime("%Y-%m-%d %H:%M:%S")))
+        m.write_to_log("LOG: At {0}: Starting script.\n".format(strftime("%Y-%m-%d %H:%M:%S")))
+
+        if args.concurrent and not args.replay:
+            providers = [(g, writer_g, TokenBucket(args.google_rate)),
+                         (m, writer_m, TokenBucket(args.mapquest_rate))]
+            try:
+                asyncio.run(collect_routes_concurrently(od_pairs, providers, start_time, args.max_in_flight))
+            except KeyboardInterrupt:
+                traceback.print_exc()
+        else:
+            collect_routes_sequentially(od_pairs, g, m, writer_g, writer_m, start_time, pause=not args.replay)
+    finally:
+        # anything collected before an interruption or crash is kept for the next --resume
+        writer_g.close()
+        writer_m.close()
+        if response_cache is not None:
+            response_cache.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,75 @@
+"""On-disk cache of raw responses from routing APIs.
+
+Responses are stored in SQLite keyed by platform, origin, destination, number of routes requested, and the
+departure-time bucket in which they were collected. This allows the routes to be re-processed (e.g. after a change
+to the output format) by replaying the cached responses rather than spending API quota.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache(object):
+
+    def __init__(self, db_fn, bucket_seconds=3600):
+        """
+        Args:
+            db_fn: path to SQLite database (created if it does not exist)
+            bucket_seconds: width of the departure-time buckets - responses collected for the same od-pair within
+                the same bucket replace each other
+        """
+        self.db_fn = db_fn
+        self.bucket_seconds = bucket_seconds
+        # APIs may be queried from several threads at once when collecting concurrently
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_fn, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                              "platform TEXT, origin TEXT, destination TEXT, num_routes INTEGER, "
+                              "departure_bucket INTEGER, retrieved_at REAL, response TEXT, "
+                              "PRIMARY KEY (platform, origin, destination, num_routes, departure_bucket))")
+
+    @staticmethod
+    def point_key(pt):
+        return "{0:.6f},{1:.6f}".format(pt[0], pt[1])
+
+    def departure_bucket(self, departure_time):
+        return int(departure_time // self.bucket_seconds)
+
+    def put(self, platform, origin, destination, num_routes, response, departure_time=None):
+        """Store the raw response for an od-pair (departure_time defaults to now, in seconds since the epoch)."""
+        if departure_time is None:
+            departure_time = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (platform, self.point_key(origin), self.point_key(destination), num_routes,
+                               self.departure_bucket(departure_time), time.time(), json.dumps(response)))
+
+    def get(self, platform, origin, destination, num_routes, departure_time=None):
+        """Get a cached response for an od-pair.
+
+        Returns:
+            Response for the departure-time bucket of departure_time (or the most recently collected response if
+            departure_time is None). None if there is no such response.
+        """
+        query = ("SELECT response FROM responses WHERE platform = ? AND origin = ? AND destination = ? "
+                 "AND num_routes = ?")
+        params = [platform, self.point_key(origin), self.point_key(destination), num_routes]
+        if departure_time is not None:
+            query += " AND departure_bucket = ?"
+            params.append(self.departure_bucket(departure_time))
+        query += " ORDER BY retrieved_at DESC LIMIT 1"
+        with self.lock:
+            row = self.conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
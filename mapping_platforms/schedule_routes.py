@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""Collect routes for several cities with several API keys per platform from one process.
+
+Each city has a daily collection window that opens at a local start time. Od-pairs are spread across all of a
+platform's keys (the key with the most quota left is used next), and each key's quota is tracked over a rolling
+24 hours so that keys can be shared by cities whose windows open at different times. When a city has used up
+every key, its collection pauses until its next window (and a key has quota again) so that routes are still
+gathered at comparable times of day. e.g.:
+
+    python mapping_platforms/schedule_routes.py --cities sf:8 nyc:8 lon:8 man:8 \
+        --google_keys api_keys/google.txt api_keys/google2.txt --mapquest_keys api_keys/mapquest.txt
+"""
+import argparse
+import asyncio
+import datetime
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from get_routes import GoogleAPI, MapquestAPI, RouteWriter, TokenBucket, UTC_ZONES, load_od_pairs, seconds_until
+from response_cache import ResponseCache
+
+QUOTA_PERIOD_SEC = 24 * 60 * 60
+
+
+class KeyQuota(object):
+    """Queries made with one API key over the last 24 hours, shared by every city that uses the key."""
+
+    def __init__(self, api_key_fn, api_limit=2500, rate=5):
+        """
+        Args:
+            api_key_fn: file containing the API key
+            api_limit: max queries allowed with the key in any 24 hours
+            rate: max queries per second with the key
+        """
+        self.api_key_fn = api_key_fn
+        self.api_limit = api_limit
+        self.rate_limiter = TokenBucket(rate)
+        self.query_times = deque()
+
+    def _expire(self, now):
+        while self.query_times and now - self.query_times[0] >= QUOTA_PERIOD_SEC:
+            self.query_times.popleft()
+
+    def remaining(self):
+        self._expire(time.time())
+        return self.api_limit - len(self.query_times)
+
+    def seconds_until_available(self):
+        """Seconds until at least one query can be made with the key (0 if there is quota left)."""
+        if self.remaining() > 0:
+            return 0
+        return max(0, self.query_times[0] + QUOTA_PERIOD_SEC - time.time())
+
+    def use(self):
+        self.query_times.append(time.time())
+
+
+class KeyPool(object):
+    """APIs for one city and platform - one per key - that queries are spread across."""
+
+    def __init__(self, apis, quotas):
+        self.apis = apis
+        self.quotas = quotas
+
+    def next_key(self):
+        """Get the (API, KeyQuota) of the key with the most quota left, or (None, None) if all keys are used up."""
+        best = max(range(0, len(self.quotas)), key=lambda i: self.quotas[i].remaining())
+        if self.quotas[best].remaining() <= 0:
+            return None, None
+        return self.apis[best], self.quotas[best]
+
+    def seconds_until_available(self):
+        return min(quota.seconds_until_available() for quota in self.quotas)
+
+    def write_to_log(self, mess_type="LOG", message=""):
+        # all of a city's APIs for a platform share a log file
+        self.apis[0].write_to_log(mess_type, message)
+
+    def end(self):
+        for api in self.apis:
+            api.end()
+
+
+def city_start_time(city, start_hour):
+    """Start of the city's collection window today (timezone-aware) for a start hour in the city's local time."""
+    city_tz = datetime.timezone(datetime.timedelta(hours=UTC_ZONES[city]))
+    return datetime.datetime.now(city_tz).replace(hour=start_hour, minute=0, second=0, microsecond=0)
+
+
+async def collect_pool_routes(pool, od_pairs, writer, executor, start_time, max_in_flight=4):
+    """Get routes for all od-pairs of a city from one platform, spreading the queries across the pool's keys.
+
+    Od-pairs already completed by writer are skipped. When no key has quota left, collection pauses until the
+    next collection window (the time of day of start_time) or until a key has quota again, whichever is later.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def get_and_write(api, od_pair):
+        routes = await loop.run_in_executor(executor, api.get_routes, od_pair['origin'], od_pair['destination'],
+                                            od_pair['id'])
+        writer.write_routes(od_pair['id'], routes)
+        if api.queries_made and api.queries_made % 500 == 0:
+            api.write_to_log("LOG", "Every 500 query check")
+        if (api.exceptions + 1) % 40 == 0:
+            api.write_to_log("TOO MANY EXCEPTIONS", "{0} exceptions reached.".format(api.exceptions))
+
+    in_flight = set()
+    for od_pair in od_pairs:
+        if writer.is_done(od_pair['id']):
+            continue
+        while len(in_flight) >= max_in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        api, quota = pool.next_key()
+        while api is None:
+            if in_flight:
+                await asyncio.wait(in_flight)
+                in_flight = set()
+            writer.flush()
+            sleep_for = max(seconds_until(start_time), pool.seconds_until_available())
+            pool.write_to_log("API LIMIT", "All keys used. Sleeping for {0} seconds. Current route ID is "
+                                           "{1}".format(round(sleep_for), od_pair['id']))
+            await asyncio.sleep(sleep_for)
+            api, quota = pool.next_key()
+        quota.use()
+        await quota.rate_limiter.acquire()
+        in_flight.add(asyncio.ensure_future(get_and_write(api, od_pair)))
+    if in_flight:
+        await asyncio.wait(in_flight)
+    writer.flush()
+    pool.end()
+
+
+async def collect_city_routes(city, start_time, od_pairs, collections, executor, max_in_flight=4):
+    """Wait for the city's collection window to open and then collect routes from every platform at once.
+
+    Args:
+        collections: list of (KeyPool, RouteWriter) for each platform
+    """
+    sleep_for = seconds_until(start_time)
+    print("{0}: will sleep for {1} seconds before starting.".format(city, sleep_for))
+    await asyncio.sleep(sleep_for)
+    for pool, writer in collections:
+        pool.write_to_log("LOG", "Starting {0} collection with {1} keys".format(city, len(pool.apis)))
+    await asyncio.gather(*[collect_pool_routes(pool, od_pairs, writer, executor, start_time, max_in_flight)
+                           for pool, writer in collections])
+    print("{0}: finished collecting routes.".format(city))
+
+
+async def run_schedule(city_jobs, max_in_flight=4):
+    """Collect routes for every city, each in its own collection window.
+
+    Args:
+        city_jobs: list of (city, start_time, od_pairs, [(KeyPool, RouteWriter) for each platform])
+        max_in_flight: maximum number of requests waiting on a response at once for each city and platform
+    """
+    num_collections = sum(len(collections) for city, start_time, od_pairs, collections in city_jobs)
+    with ThreadPoolExecutor(max_workers=max_in_flight * num_collections) as executor:
+        await asyncio.gather(*[collect_city_routes(city, start_time, od_pairs, collections, executor, max_in_flight)
+                               for city, start_time, od_pairs, collections in city_jobs])
+
+
+def parse_city(city_str):
+    """Parse 'city:start_hour' (e.g. 'sf:8')."""
+    city, start_hour = city_str.split(":")
+    if city not in UTC_ZONES:
+        raise argparse.ArgumentTypeError("Invalid city {0}. Must be one of {1}.".format(city, list(UTC_ZONES.keys())))
+    return city, int(start_hour)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cities", nargs="+", type=parse_city, required=True,
+                        help="Cities and the hour (00-24, local time) that their collection starts, e.g. sf:8 nyc:8")
+    parser.add_argument("--google_keys", nargs="+", default=["api_keys/google.txt"], help="Google API key files")
+    parser.add_argument("--mapquest_keys", nargs="+", default=["api_keys/mapquest.txt"], help="Mapquest API key files")
+    parser.add_argument("--api_limit", type=int, default=2500, help="Max queries per key in any 24 hours")
+    parser.add_argument("--google_rate", type=float, default=5, help="Max Google requests per second per key")
+    parser.add_argument("--mapquest_rate", type=float, default=5, help="Max Mapquest requests per second per key")
+    parser.add_argument("--max_in_flight", type=int, default=4, help="Max requests awaiting a response per city and API")
+    parser.add_argument("--resume", action="store_true", help="Append to existing output and skip od-pairs already collected")
+    parser.add_argument("--flush_interval", type=float, default=30, help="Seconds between writing batches of routes to disk")
+    parser.add_argument("--response_cache", default=None, help="SQLite file in which to store raw API responses")
+    args = parser.parse_args()
+
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(args.response_cache)
+    # keys (and their quotas) are shared by all cities
+    platforms = [(GoogleAPI, [KeyQuota(fn, args.api_limit, args.google_rate) for fn in args.google_keys]),
+                 (MapquestAPI, [KeyQuota(fn, args.api_limit, args.mapquest_rate) for fn in args.mapquest_keys])]
+
+    city_jobs = []
+    writers = []
+    try:
+        for city, start_hour in args.cities:
+            od_pairs = load_od_pairs("data/intermediate/{0}_grid_od_pairs.csv".format(city))
+            collections = []
+            for api_class, quotas in platforms:
+                apis = []
+                for quota in quotas:
+                    kwargs = {'pool_size': args.max_in_flight} if api_class is MapquestAPI else {}
+                    api = api_class(api_key_fn=quota.api_key_fn, api_limit=quota.api_limit, city=city,
+                                    route_type="grid", output_num=2, **kwargs)
+                    if response_cache is not None:
+                        api.use_response_cache(response_cache)
+                    apis.append(api)
+                writer = RouteWriter("data/intermediate/{0}_grid_{1}_routes.csv".format(city, api_class.platform),
+                                     resume=args.resume, flush_interval=args.flush_interval)
+                writers.append(writer)
+                if args.resume:
+                    print("Resuming {0}: {1} {2} od-pairs already collected.".format(city, len(writer.done),
+                                                                                    api_class.platform))
+                collections.append((KeyPool(apis, quotas), writer))
+            city_jobs.append((city, city_start_time(city, start_hour), od_pairs, collections))
+
+        try:
+            asyncio.run(run_schedule(city_jobs, args.max_in_flight))
+        except KeyboardInterrupt:
+            traceback.print_exc()
+    finally:
+        # anything collected before an interruption or crash is kept for the next --resume
+        for writer in writers:
+            writer.close()
+        if response_cache is not None:
+            response_cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""Local stand-in for the Google and Mapquest directions APIs.
+
+Serves Google Directions-shaped (/maps/api/directions/json) and Mapquest route / alternateroutes-shaped
+(/directions/v2/route, /directions/v2/alternateroutes) responses with straight-line routes between the requested
+origin and destination. Latency, server errors, and per-platform rate limits can be configured so that the route
+collector can be load-tested without spending quota. See benchmark_collector.py.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# responses are encoded with the collector's own encoder so that benchmarks also exercise its decoder
+from get_routes import encode_polyline
+
+GOOGLE_PATH = "/maps/api/directions/json"
+MAPQUEST_PATHS = ["/directions/v2/route", "/directions/v2/alternateroutes"]
+
+
+def straight_route(origin, destination, num_steps, points_per_step, detour=0.0):
+    """List of steps, each a list of (lat, lon) points, along a (possibly bowed) line from origin to destination."""
+    num_points = num_steps * points_per_step + 1
+    points = []
+    for i in range(0, num_points):
+        frac = i / (num_points - 1)
+        bow = detour * frac * (1 - frac)
+        points.append((origin[0] + (destination[0] - origin[0]) * frac + bow,
+                       origin[1] + (destination[1] - origin[1]) * frac - bow))
+    # consecutive steps share their join point, like the real API
+    return [points[i * points_per_step:(i + 1) * points_per_step + 1] for i in range(0, num_steps)]
+
+
+def route_length_km(points):
+    return sum(((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5 for a, b in zip(points, points[1:])) * 111
+
+
+class StandinConfig(object):
+
+    def __init__(self, latency=0.1, latency_jitter=0.05, error_rate=0.0, google_rate_limit=None,
+                 mapquest_rate_limit=None, num_steps=12, points_per_step=8, seed=None):
+        """
+        Args:
+            latency: mean seconds before responding
+            latency_jitter: responses are delayed by latency +/- up to latency_jitter seconds
+            error_rate: fraction of requests answered with an HTTP 500
+            google_rate_limit: requests per second before Google responses are OVER_QUERY_LIMIT (None for no limit)
+            mapquest_rate_limit: requests per second before Mapquest responses are HTTP 429 (None for no limit)
+            num_steps: steps (maneuvers) per route
+            points_per_step: polyline points per step
+            seed: seed for latency and errors
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limits = {'google': google_rate_limit, 'mapquest': mapquest_rate_limit}
+        self.num_steps = num_steps
+        self.points_per_step = points_per_step
+        self.random = random.Random(seed)
+
+
+class StandinStats(object):
+    """Thread-safe record of requests received by the stand-in server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_times = {'google': [], 'mapquest': []}
+        self.rate_limited = {'google': 0, 'mapquest': 0}
+        self.errors = {'google': 0, 'mapquest': 0}
+
+    def record(self, platform):
+        """Record a request and return how many requests for platform arrived in the last second."""
+        now = time.monotonic()
+        with self.lock:
+            times = self.request_times[platform]
+            times.append(now)
+            recent = 0
+            for t in reversed(times):
+                if now - t > 1:
+                    break
+                recent += 1
+            return recent
+
+    def max_per_second(self, platform):
+        """Most requests received for platform within any one-second window."""
+        with self.lock:
+            times = list(self.request_times[platform])
+        most = 0
+        start = 0
+        for end in range(0, len(times)):
+            while times[end] - times[start] > 1:
+                start += 1
+            most = max(most, end - start + 1)
+        return most
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):
+        return
+
+    def send_json(self, body, status=200):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        config = self.server.config
+        stats = self.server.stats
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == GOOGLE_PATH:
+            platform = "google"
+        elif url.path in MAPQUEST_PATHS:
+            platform = "mapquest"
+        else:
+            self.send_json({"error": "unknown path {0}".format(url.path)}, status=404)
+            return
+
+        recent = stats.record(platform)
+        with stats.lock:
+            delay = max(0, config.latency + config.random.uniform(-config.latency_jitter, config.latency_jitter))
+            fail = config.random.random() < config.error_rate
+        time.sleep(delay)
+
+        rate_limit = config.rate_limits[platform]
+        if rate_limit is not None and recent > rate_limit:
+            with stats.lock:
+                stats.rate_limited[platform] += 1
+            if platform == "google":
+                self.send_json({"status": "OVER_QUERY_LIMIT", "routes": []})
+            else:
+                self.send_json({"info": {"statuscode": 429, "messages": ["Rate limit exceeded"]}}, status=429)
+            return
+        if fail:
+            with stats.lock:
+                stats.errors[platform] += 1
+            self.send_json({"error": "stand-in server error"}, status=500)
+            return
+
+        if platform == "google":
+            self.send_json(self.google_response(params))
+        else:
+            self.send_json(self.mapquest_response(url.path, params))
+
+    def od_pair(self, origin_str, destination_str):
+        origin = tuple(float(c) for c in origin_str.split(","))
+        destination = tuple(float(c) for c in destination_str.split(","))
+        return origin, destination
+
+    def google_response(self, params):
+        config = self.server.config
+        origin, destination = self.od_pair(params['origin'], params['destination'])
+        num_routes = 3 if params.get('alternatives') == 'true' else 1
+        routes = []
+        for i in range(0, num_routes):
+            steps = straight_route(origin, destination, config.num_steps, config.points_per_step, detour=0.002 * i)
+            length_km = sum(route_length_km(step) for step in steps)
+            routes.append({'legs': [{
+                'steps': [{'polyline': {'points': encode_polyline(step)}, 'maneuver': 'turn-left'}
+                          for step in steps],
+                'duration': {'value': round(length_km * 90)},
+                'distance': {'value': round(length_km * 1000)}}]})
+        return {'status': 'OK', 'routes': routes}
+
+    def mapquest_route(self, origin, destination, detour):
+        config = self.server.config
+        steps = straight_route(origin, destination, config.num_steps, config.points_per_step, detour=detour)
+        points = [steps[0][0]] + [pt for step in steps for pt in step[1:]]
+        length_km = route_length_km(points)
+        return {'legs': [{'maneuvers': [{'turnType': i % 8} for i in range(0, config.num_steps)]}],
+                'shape': {'shapePoints': [c for pt in points for c in pt]},
+                'realTime': round(length_km * 95), 'time': round(length_km * 90), 'distance': length_km}
+
+    def mapquest_response(self, path, params):
+        origin, destination = self.od_pair(params['from'], params['to'])
+        route = self.mapquest_route(origin, destination, 0)
+        if path.endswith("alternateroutes"):
+            max_routes = int(params.get('maxRoutes', 1))
+            route['alternateRoutes'] = [{'route': self.mapquest_route(origin, destination, 0.002 * i)}
+                                        for i in range(1, max_routes)]
+        return {'route': route, 'info': {'statuscode': 0}}
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """Create the stand-in server (port 0 binds any free port).
+
+    Returns:
+        server: server whose stats attribute records requests and whose server_address gives the bound port
+    """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = StandinStats()
+    return server
+
+
+def start_server(config, host="127.0.0.1", port=0):
+    """Start the stand-in server in a background thread.
+
+    Returns:
+        server: server whose stats attribute records requests and whose server_address gives the bound port.
+            Call server.shutdown() when finished.
+    """
+    server = make_server(config, host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean seconds before responding")
+    parser.add_argument("--latency_jitter", type=float, default=0.05, help="Max seconds added / removed from latency")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--google_rate_limit", type=float, default=None, help="Google requests per second allowed")
+    parser.add_argument("--mapquest_rate_limit", type=float, default=None, help="Mapquest requests per second allowed")
+    args = parser.parse_args()
+
+    config = StandinConfig(latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                           google_rate_limit=args.google_rate_limit, mapquest_rate_limit=args.mapquest_rate_limit)
+    server = make_server(config, port=args.port)
+    print("Stand-in server listening on http://127.0.0.1:{0}".format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Precompute crime counts by grid cell, crime category, and day so that crime scores can be recomputed for any date
+window or set of crime categories without rescanning the crime CSV.
+
+    python preprocessing/crime_cube.py build data/sf_crime.csv data/sf_grid.geojson
+    python preprocessing/crime_cube.py query data/sf_grid_crime_cube.npz --start_date 2016-01-01 --end_date 2016-12-31
+
+query writes the same CSV (count_ugc, count_words, and a column per crime category) as generate_grid_scores.py.
+"""
+import argparse
+import os
+
+import numpy
+
+from generate_grid_scores import GridScores, filter_block, load_grid, parse_dates, preprocess_ugc, \
+    print_progress, read_blocks, source_config, ugc_chunks
+
+# days are stored in the cube's keys as days since 1970 plus DAY_OFFSET so that they are never negative
+DAY_OFFSET = 2 ** 16
+CELL_SHIFT = 16
+DAY_SHIFT = 40
+
+
+def to_days(dates):
+    """Convert an array of YYYYMMDD ints to datetime64[D]."""
+    years = (dates // 10000 - 1970).astype('datetime64[Y]')
+    months = years.astype('datetime64[M]') + (dates // 100 % 100 - 1)
+    return months.astype('datetime64[D]') + (dates % 100 - 1)
+
+
+class CrimeCube(object):
+    """Counts of crimes by grid cell, crime category, and day, stored as sparse (COO) arrays sorted by day so that a
+    date window is a contiguous slice.
+
+    Attributes:
+        keys: (rid, cid) of each grid cell
+        grid_keys: (rid, cid) of each grid cell in the order of the grid GeoJSON (used for output)
+        crime_categories: every crime category in the crime data
+        default_categories: crime categories scored by generate_grid_scores.py for the city
+        days: datetime64[D] array of the day of each entry
+        cells: grid cell (index of keys) of each entry
+        categories: crime category (index of crime_categories) of each entry
+        counts: number of crimes of each entry
+    """
+
+    def __init__(self, keys, grid_keys, crime_categories, default_categories, days, cells, categories, counts):
+        self.keys = keys
+        self.grid_keys = grid_keys
+        self.crime_categories = crime_categories
+        self.default_categories = default_categories
+        self.days = days
+        self.cells = cells
+        self.categories = categories
+        self.counts = counts
+
+    @classmethod
+    def build(cls, crime_fn, grid_geojson_fn):
+        """Count the crimes in a crime CSV (see source_config) by grid cell, crime category, and day."""
+        source = source_config(crime_fn, None)
+        if source['repo'] != 'crime':
+            raise ValueError("{0} is not a crime file.".format(crime_fn))
+        # every date is kept in the cube
+        source['date_window'] = None
+        grid_keys, grid_index, county_bb = load_grid(grid_geojson_fn)
+        bounds = county_bb.bounds
+        stats = {'points_analyzed': 0, 'found_first_try': 0, 'not_found': 0, 'points_skipped': 0, 'no_lat_lon': 0}
+        crime_categories = {}
+        block_codes = []
+        block_counts = []
+        start, end = ugc_chunks(crime_fn, 1)[0]
+        for block in read_blocks(crime_fn, start, end):
+            rows, ys, xs, has_coords, in_bounds = filter_block(block, source, bounds)
+            stats['no_lat_lon'] += int(numpy.count_nonzero(~has_coords))
+            stats['points_skipped'] += int(numpy.count_nonzero(has_coords & ~in_bounds))
+            keep = numpy.flatnonzero(has_coords & in_bounds)
+            dates = parse_dates([block[rows[i]][source['date_idx']] for i in keep])
+            dated = dates > 0
+            keep = keep[dated]
+            cells, first_try = grid_index.locate(ys[keep], xs[keep])
+            stats['points_analyzed'] += len(keep)
+            stats['found_first_try'] += int(numpy.count_nonzero(first_try))
+            stats['not_found'] += int(numpy.count_nonzero(cells < 0))
+
+            located = cells >= 0
+            categories = numpy.array([crime_categories.setdefault(preprocess_ugc(block[rows[i]][source['ugc_idx']],
+                                                                                 'crime', None),
+                                                                  len(crime_categories))
+                                      for i in keep[located]], dtype=numpy.int64)
+            days = to_days(dates[dated][located]).astype(numpy.int64) + DAY_OFFSET
+            codes = (days << DAY_SHIFT) | (cells[located] << CELL_SHIFT) | categories
+            codes, counts = numpy.unique(codes, return_counts=True)
+            block_codes.append(codes)
+            block_counts.append(counts)
+            print_progress(stats)
+
+        codes, inverse = numpy.unique(numpy.concatenate(block_codes + [numpy.empty(0, dtype=numpy.int64)]),
+                                      return_inverse=True)
+        counts = numpy.bincount(inverse, weights=numpy.concatenate(block_counts + [numpy.empty(0)]),
+                                minlength=len(codes)).astype(numpy.int64)
+        days = ((codes >> DAY_SHIFT) - DAY_OFFSET).astype('datetime64[D]')
+        cells = (codes >> CELL_SHIFT) & ((1 << (DAY_SHIFT - CELL_SHIFT)) - 1)
+        categories = codes & ((1 << CELL_SHIFT) - 1)
+        return cls(grid_index.keys, grid_keys, list(crime_categories.keys()), source['categories'], days, cells,
+                   categories, counts)
+
+    def save(self, cube_fn):
+        keys = numpy.array(self.keys, dtype=numpy.int64).reshape(-1, 2)
+        grid_keys = numpy.array(self.grid_keys, dtype=numpy.int64).reshape(-1, 2)
+        with open(cube_fn, 'wb') as fout:
+            numpy.savez_compressed(fout, rid=keys[:, 0], cid=keys[:, 1], grid_rid=grid_keys[:, 0],
+                                   grid_cid=grid_keys[:, 1], crime_categories=numpy.array(self.crime_categories),
+                                   default_categories=numpy.array(self.default_categories), days=self.days,
+                                   cells=self.cells.astype(numpy.int32), categories=self.categories.astype(numpy.int32),
+                                   counts=self.counts.astype(numpy.int32))
+
+    @classmethod
+    def load(cls, cube_fn):
+        with numpy.load(cube_fn) as cube:
+            return cls(list(zip(cube['rid'].tolist(), cube['cid'].tolist())),
+                       list(zip(cube['grid_rid'].tolist(), cube['grid_cid'].tolist())),
+                       cube['crime_categories'].tolist(), cube['default_categories'].tolist(), cube['days'],
+                       cube['cells'].astype(numpy.int64), cube['categories'].astype(numpy.int64),
+                       cube['counts'].astype(numpy.int64))
+
+    def date_slice(self, start_date, end_date):
+        """Slice of the entries from start_date through end_date (YYYY-MM-DD, inclusive)."""
+        start = numpy.searchsorted(self.days, numpy.datetime64(start_date, 'D'), side='left')
+        end = numpy.searchsorted(self.days, numpy.datetime64(end_date, 'D'), side='right')
+        return slice(start, end)
+
+    def grid_scores(self, start_date, end_date, categories=None):
+        """Crime counts of each grid cell from start_date through end_date (YYYY-MM-DD, inclusive).
+
+        Args:
+            categories: crime categories to count (default_categories if None) - categories without any crimes are
+                included with counts of 0
+
+        Returns:
+            GridScores with the number of crimes (count_ugc), the number of crimes in the categories (count_words),
+            and the number of crimes in each category (scores) for each grid cell
+        """
+        if categories is None:
+            categories = self.default_categories
+        entries = self.date_slice(start_date, end_date)
+        cells = self.cells[entries]
+        counts = self.counts[entries]
+        # column of each crime category in the scores (-1 if not counted)
+        columns = numpy.full(len(self.crime_categories) + 1, -1, dtype=numpy.int64)
+        category_idx = {self.crime_categories[i]: i for i in range(0, len(self.crime_categories))}
+        for k in range(0, len(categories)):
+            columns[category_idx.get(categories[k], -1)] = k
+        entry_columns = columns[self.categories[entries]]
+        counted = entry_columns >= 0
+
+        grid_scores = GridScores(self.keys, categories)
+        grid_scores.count_ugc = numpy.bincount(cells, weights=counts, minlength=len(self.keys)).astype(numpy.int64)
+        grid_scores.count_words = numpy.bincount(cells[counted], weights=counts[counted],
+                                                 minlength=len(self.keys)).astype(numpy.int64)
+        grid_scores.scores = numpy.bincount(cells[counted] * len(categories) + entry_columns[counted],
+                                            weights=counts[counted], minlength=len(self.keys) * len(categories))
+        grid_scores.scores = grid_scores.scores.reshape(len(self.keys), len(categories))
+        return grid_scores
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    build_parser = subparsers.add_parser("build", help="Count the crimes in a crime CSV for a grid.")
+    build_parser.add_argument("crime_fn",
+                              help="File path of the CSV file containing crime data for the city.")
+    build_parser.add_argument("grid_geojson_fn",
+                              help="File path of the GeoJSON file (or raster grid .npz) containing the grid cells "
+                                   "for the city.")
+    build_parser.add_argument("--cube_fn", default=None,
+                              help="File path of the crime cube (default: next to the grid GeoJSON).")
+    query_parser = subparsers.add_parser("query", help="Write crime scores for a date window and crime categories.")
+    query_parser.add_argument("cube_fn",
+                              help="File path of the crime cube.")
+    query_parser.add_argument("--start_date", default="2016-01-01",
+                              help="First day (YYYY-MM-DD) of crimes to include.")
+    query_parser.add_argument("--end_date", default="2016-12-31",
+                              help="Last day (YYYY-MM-DD) of crimes to include.")
+    query_parser.add_argument("--categories", nargs="+", default=None,
+                              help="Crime categories to count (default: the city's categories in generate_grid_scores.py).")
+    query_parser.add_argument("--csv_out_fn", default=None,
+                              help="File path of the output CSV (default: next to the crime cube).")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        cube_fn = args.cube_fn
+        if cube_fn is None:
+            cube_fn = os.path.splitext(args.grid_geojson_fn)[0] + "_crime_cube.npz"
+        cube = CrimeCube.build(args.crime_fn, args.grid_geojson_fn)
+        cube.save(cube_fn)
+        print("{0} crimes in {1} entries from {2} to {3} saved to {4}.".format(
+            cube.counts.sum(), len(cube.counts), cube.days.min(), cube.days.max(), cube_fn))
+    elif args.command == "query":
+        cube = CrimeCube.load(args.cube_fn)
+        grid_scores = cube.grid_scores(args.start_date, args.end_date, args.categories)
+        csv_out_fn = args.csv_out_fn
+        if csv_out_fn is None:
+            csv_out_fn = args.cube_fn.replace("_cube.npz", "_empath.csv")
+        grid_scores.write_csv(csv_out_fn, cube.grid_keys, fraction=False)
+        print("{0} crimes ({1} in the categories) from {2} to {3}.".format(
+            grid_scores.count_ugc.sum(), grid_scores.count_words.sum(), args.start_date, args.end_date))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
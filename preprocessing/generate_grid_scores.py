@@ -1,17 +1,199 @@
 """Generate grid cell scores from Empath analysis of user-generated content."""
 import csv
+import io
 import json
 import argparse
+import os
 import re
 import traceback
-from math import floor
+from multiprocessing import Pool
 
 from nltk.stem import WordNetLemmatizer
 import numpy
 from shapely.geometry import shape, box, point
 from empath import Empath
 
+from grid_creation import RasterGrid
+
 SCALE = 3
+BATCH_SIZE = 10000
+# bytes of a UGC file that are read, parsed, and filtered together
+INGEST_BLOCK_BYTES = 1024 * 1024
+# crimes must have been committed in the past year unless another date window is given
+CRIME_DATE_WINDOW = ('2016-01-01', '2016-12-31')
+# order in which grid cells around the best guess are searched: best guess and then three grid cells to either side
+ADJ_IDX = [0, 1, -1, 2, -2, 3, -3]
+LEMMA_CACHE_SIZE = 200000
+WORD_SPLIT = re.compile(r"\W+")
+
+
+def is_box(geom):
+    """True if geom is a polygon whose exterior is an axis-aligned rectangle (i.e. equal to its bounding box)."""
+    if geom.geom_type != "Polygon" or geom.interiors or len(geom.exterior.coords) != 5:
+        return False
+    coords = list(geom.exterior.coords)
+    minx, miny, maxx, maxy = geom.bounds
+    if minx == maxx or miny == maxy:
+        return False
+    for (x1, y1), (x2, y2) in zip(coords, coords[1:]):
+        if x1 not in (minx, maxx) or y1 not in (miny, maxy) or ((x1 == x2) == (y1 == y2)):
+            return False
+    return True
+
+
+class GridIndex(object):
+    """Arithmetic lookup of the grid cell that contains each of a batch of points.
+
+    The best guess for the cell containing a point is (floor(y * 10**SCALE), floor(x * 10**SCALE)), but grid rows are
+    not necessarily aligned with multiples of 10**-SCALE (and a grid may combine several lattices), so the cells
+    around the best guess are searched in the same order as ADJ_IDX. Rather than testing each cell's geometry, points
+    are compared with the cell bounds for whole batches at once. Only points that fall within EDGE_TOLERANCE of a
+    candidate cell's edge (or near cells that are not rectangles) are checked against the exact cell geometry, so the
+    cell assignment is the same as testing shape.contains for every candidate.
+    """
+
+    EDGE_TOLERANCE = 1e-9
+
+    def __init__(self, keys, shapes):
+        """
+        Args:
+            keys: list of (rid, cid) of each grid cell
+            shapes: list of Shapely geometries of each grid cell
+        """
+        self.keys = keys
+        self.shapes = shapes
+        bounds = numpy.array([s.bounds for s in shapes], dtype=numpy.float64).reshape(-1, 4)
+        self.minx, self.miny, self.maxx, self.maxy = bounds.T
+        # cells are expected to be axis-aligned boxes - anything else is always checked with its geometry
+        self.rectangular = numpy.array([is_box(s) for s in shapes], dtype=bool)
+        rids = numpy.array([k[0] for k in keys], dtype=numpy.int64)
+        cids = numpy.array([k[1] for k in keys], dtype=numpy.int64)
+        self.min_rid = rids.min()
+        self.min_cid = cids.min()
+        self.table = numpy.full((rids.max() - self.min_rid + 1, cids.max() - self.min_cid + 1), -1, dtype=numpy.int64)
+        self.table[rids - self.min_rid, cids - self.min_cid] = numpy.arange(len(keys))
+
+    def cells_at(self, rids, cids):
+        """Index of the grid cell with each (rid, cid) or -1 if there is no such cell."""
+        rows = rids - self.min_rid
+        cols = cids - self.min_cid
+        in_table = (rows >= 0) & (rows < self.table.shape[0]) & (cols >= 0) & (cols < self.table.shape[1])
+        idx = numpy.full(len(rids), -1, dtype=numpy.int64)
+        idx[in_table] = self.table[rows[in_table], cols[in_table]]
+        return idx
+
+    def locate(self, ys, xs):
+        """Find the grid cell containing each point.
+
+        Args:
+            ys: array of latitudes
+            xs: array of longitudes
+        Returns:
+            cell_idx: index of the grid cell containing each point (-1 if none of the searched cells contain it)
+            first_try: True for points found in their best guess cell
+        """
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        best_rids = numpy.floor(ys * 10 ** SCALE).astype(numpy.int64)
+        best_cids = numpy.floor(xs * 10 ** SCALE).astype(numpy.int64)
+        cell_idx = numpy.full(len(ys), -1, dtype=numpy.int64)
+        first_try = numpy.zeros(len(ys), dtype=bool)
+        resolved = numpy.zeros(len(ys), dtype=bool)
+        near_edge = numpy.zeros(len(ys), dtype=bool)
+        tol = self.EDGE_TOLERANCE
+        pending = numpy.arange(len(ys))
+        for i in ADJ_IDX:
+            for j in ADJ_IDX:
+                pending = pending[~resolved[pending]]
+                idx = self.cells_at(best_rids[pending] + i, best_cids[pending] + j)
+                pts = pending[idx >= 0]
+                if not len(pts):
+                    continue
+                cells = idx[idx >= 0]
+                y = ys[pts]
+                x = xs[pts]
+                inside = ((x - self.minx[cells] > tol) & (self.maxx[cells] - x > tol) &
+                          (y - self.miny[cells] > tol) & (self.maxy[cells] - y > tol) & self.rectangular[cells])
+                outside = ((self.minx[cells] - x > tol) | (x - self.maxx[cells] > tol) |
+                           (self.miny[cells] - y > tol) | (y - self.maxy[cells] > tol))
+                # the first cell that contains a point is used, so a point that cannot be ruled in or out of a
+                # cell before it is found is left for the exact geometry check
+                uncertain = ~inside & ~outside
+                near_edge[pts[uncertain]] = True
+                resolved[pts[uncertain]] = True
+                found = pts[inside]
+                cell_idx[found] = cells[inside]
+                first_try[found] = (i == 0 and j == 0)
+                resolved[found] = True
+
+        for p in numpy.flatnonzero(near_edge):
+            cell_idx[p], first_try[p] = self.locate_exact(ys[p], xs[p], best_rids[p], best_cids[p])
+        return cell_idx, first_try
+
+    def locate_exact(self, y, x, best_rid, best_cid):
+        """Find the grid cell containing a point by testing the geometry of each cell around the best guess."""
+        pt = point.Point(x, y)
+        num_rows, num_cols = self.table.shape
+        for i in ADJ_IDX:
+            row = best_rid + i - self.min_rid
+            if row < 0 or row >= num_rows:
+                continue
+            for j in ADJ_IDX:
+                col = best_cid + j - self.min_cid
+                if col < 0 or col >= num_cols:
+                    continue
+                idx = self.table[row, col]
+                if idx >= 0 and self.shapes[idx].contains(pt):
+                    return idx, (i == 0 and j == 0)
+        return -1, False
+
+
+class CachedLemmatizer(object):
+    """Lemmatizer that remembers the lemma of each word so that repeated words do not need to be lemmatized again.
+
+    Words can be lemmatized ahead of time with prelemmatize (e.g. the vocabulary of a UGC file from
+    ugc_vocabulary) and are then kept for good. Other words are kept in a cache of up to max_size words, from
+    which the oldest word is dropped when it is full.
+    """
+
+    def __init__(self, lemmatizer, max_size=LEMMA_CACHE_SIZE, vocabulary=None):
+        """
+        Args:
+            lemmatizer: lemmatizer object to be used (e.g. WordNetLemmatizer)
+            max_size: max number of words to cache in addition to the vocabulary
+            vocabulary: dictionary of word to lemma for words that have already been lemmatized
+        """
+        self.lemmatizer = lemmatizer
+        self.max_size = max_size
+        self.vocabulary = vocabulary if vocabulary is not None else {}
+        self.cache = {}
+
+    def lemmatize(self, word):
+        lemma = self.vocabulary.get(word)
+        if lemma is None:
+            lemma = self.cache.get(word)
+            if lemma is None:
+                lemma = self.lemmatizer.lemmatize(word)
+                if len(self.cache) >= self.max_size:
+                    del self.cache[next(iter(self.cache))]
+                self.cache[word] = lemma
+        return lemma
+
+    def prelemmatize(self, words):
+        """Lemmatize each word (that has not been already) and add it to the vocabulary."""
+        for word in words:
+            if word not in self.vocabulary:
+                self.vocabulary[word] = self.lemmatizer.lemmatize(word)
+
+
+def ugc_words(ugc, repo):
+    """Words of a piece of UGC that are lemmatized by preprocess_ugc."""
+    if repo == "flickr":
+        return [word for tag in ugc.strip("{}").lower().split(',') for word in tag.split("+")]
+    elif repo == "twitter":
+        return WORD_SPLIT.split(ugc.lower())
+    return []
+
 
 def preprocess_ugc(ugc, repo, lemmatizer):
     """Perform text preprocessing steps on tweet or photo tags
@@ -21,7 +203,7 @@ def preprocess_ugc(ugc, repo, lemmatizer):
     Args:
         ugc: String containing photo tags or tweet text
         repo: flickr or twitter
-        lemmatizer: lemmatizer object to be used
+        lemmatizer: lemmatizer object to be used (e.g. a CachedLemmatizer)
 
     Returns:
         A list of preprocessed text, either words for a tweet or tags for a photo.
@@ -41,7 +223,7 @@ def preprocess_ugc(ugc, repo, lemmatizer):
             ugc[i] = " ".join(tag)
     elif repo == "twitter":
         # list of words
-        ugc = re.split("\W+", ugc.lower())
+        ugc = WORD_SPLIT.split(ugc.lower())
         num_words = len(ugc)
         for i in range(0, num_words):
             ugc[i] = lemmatizer.lemmatize(ugc[i])
@@ -50,92 +232,328 @@ def preprocess_ugc(ugc, repo, lemmatizer):
     return ugc
 
 
-def analyze_ugc(gridcells, key, ugc, user, lexicon, repo, categories, first_ugc_only=False):
-    """Analyze UGC and update gridcells.
+class CompiledLexicon(object):
+    """Empath lexicon compiled into a sparse token x category matrix so that whole batches of UGC can be scored at once.
+
+    The matrix is stored in compressed sparse row form: the categories of the token with ID t are
+    indices[indptr[t]:indptr[t + 1]]. Scores match lexicon.analyze(ugc, categories=categories): documents are
+    joined with newlines and split on whitespace, and each token adds 1 to each category that lists it (as many
+    times as the category lists it).
+    """
 
-    Only first UGC from a user retained for a grid cell
+    def __init__(self, lexicon, categories):
+        """
+        Args:
+            lexicon: Empath lexicon
+            categories: Empath categories to include in analysis (in the order of the score columns)
+        """
+        self.categories = list(categories)
+        self.vocab = {}
+        token_ids = []
+        category_ids = []
+        for k in range(0, len(self.categories)):
+            for term in lexicon.cats.get(self.categories[k], []):
+                token_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                category_ids.append(k)
+        token_ids = numpy.array(token_ids, dtype=numpy.int64)
+        order = numpy.argsort(token_ids, kind="stable")
+        self.indices = numpy.array(category_ids, dtype=numpy.int64)[order]
+        self.indptr = numpy.zeros(len(self.vocab) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(token_ids, minlength=len(self.vocab)), out=self.indptr[1:])
 
-    Args:
-        gridcells: dictionary of gridcells with appropriate statistics
-        key: gridcell to be updated
-        ugc: list of tags or words depending on repository
-        user: userID string to prevent multiple UGC from a user in a cell
-        lexicon: Empath lexicon
-        repo: UGC repository - either flickr, twitter, or placepulse
-        categories: Empath categories to include in analysis
-        first_ugc_only: if True, only include first post from any user for a cell
+    def score(self, docs):
+        """Score a batch of UGC.
 
-    Returns:
-        Void, updates gridcell dictionary appropriately
+        Args:
+            docs: list of UGC, each a string or a list of words / tags
+        Returns:
+            (len(docs), len(categories)) array of the count of tokens in each category for each piece of UGC
+        """
+        vocab = self.vocab
+        doc_ids = []
+        token_ids = []
+        for d in range(0, len(docs)):
+            doc = docs[d]
+            if isinstance(doc, list):
+                doc = "\n".join(doc)
+            for token in doc.split():
+                t = vocab.get(token)
+                if t is not None:
+                    doc_ids.append(d)
+                    token_ids.append(t)
+        doc_ids = numpy.array(doc_ids, dtype=numpy.int64)
+        token_ids = numpy.array(token_ids, dtype=numpy.int64)
+
+        # sparse (doc x token) times (token x category): expand each token occurrence into its row of the matrix
+        starts = self.indptr[token_ids]
+        lengths = self.indptr[token_ids + 1] - starts
+        entry_docs = numpy.repeat(doc_ids, lengths)
+        entry_offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        entry_categories = self.indices[numpy.repeat(starts, lengths) + entry_offsets]
+        num_categories = len(self.categories)
+        counts = numpy.bincount(entry_docs * num_categories + entry_categories, minlength=len(docs) * num_categories)
+        return counts.reshape(len(docs), num_categories).astype(numpy.float64)
+
+
+class GridScores(object):
+    """Totals of the UGC scores of every grid cell, stored as arrays with a row per grid cell.
+
+    The totals are raw counts (not logged fractions), so they can be saved as a snapshot and more UGC folded in later
+    (see save and load).
+
+    Attributes:
+        keys: (rid, cid) of the grid cell in each row
+        categories: category in each column of scores
+        first_ugc_only: True if only the first UGC from any user is included for each grid cell
+        count_ugc: (cells,) array of the number of pieces of UGC in each grid cell
+        count_words: (cells,) array of the number of words (or crimes in the categories) in each grid cell
+        scores: (cells, categories) array of the summed category scores of each grid cell
+        user_ids: dictionary of user to integer ID
+        user_codes: sorted array of (row << 32) | user ID for each user with UGC counted in a grid cell, which is
+            used to only include the first UGC from any user for a cell (first_ugc_only)
     """
 
-    if first_ugc_only:
-        if user in gridcells[key]['users']:
+    def __init__(self, keys, categories, first_ugc_only=False):
+        self.keys = list(keys)
+        self.rows = {self.keys[i]: i for i in range(0, len(self.keys))}
+        self.categories = list(categories)
+        self.first_ugc_only = first_ugc_only
+        self.count_ugc = numpy.zeros(len(self.keys), dtype=numpy.int64)
+        self.count_words = numpy.zeros(len(self.keys), dtype=numpy.int64)
+        self.scores = numpy.zeros((len(self.keys), len(self.categories)), dtype=numpy.float64)
+        self.user_ids = {}
+        self.user_codes = numpy.empty(0, dtype=numpy.int64)
+
+    def merge(self, chunk):
+        """Add the scores from a range of a UGC file (ranges must be merged in the order they appear in the file)."""
+        if chunk.first_ugc_only != self.first_ugc_only:
+            raise ValueError("Cannot merge UGC scored with first_ugc_only={0} into grid scores with "
+                             "first_ugc_only={1}.".format(chunk.first_ugc_only, self.first_ugc_only))
+        if not chunk.first_ugc_only:
+            self.count_ugc[chunk.rows] += chunk.count_ugc
+            self.count_words[chunk.rows] += chunk.count_words
+            self.scores[chunk.rows] += chunk.scores
             return
-        else:
-            gridcells[key]['users'].add(user)
 
-    if repo == 'twitter' or repo == 'flickr':
-        emotions = lexicon.analyze(ugc, categories=categories)
-        gridcells[key]['count_ugc'] += 1
-        gridcells[key]['count_words'] += len(ugc)
-        for category in emotions:
-            gridcells[key][category] += emotions[category]
-    elif repo == "crime":
-        gridcells[key]['count_ugc'] += 1
-        if ugc in gridcells[key]:
-            gridcells[key]['count_words'] += 1
-            gridcells[key][ugc] += 1
-    else:
-        print("Do not recognize repo {0}.".format(repo))
+        user_ids = numpy.array([self.user_ids.setdefault(user, len(self.user_ids)) for user in chunk.users],
+                               dtype=numpy.int64)
+        codes = (chunk.rows << 32) | user_ids
+        # keep a user's UGC for a cell only if no earlier range had UGC from the user for the cell
+        is_new = ~numpy.isin(codes, self.user_codes)
+        self.user_codes = numpy.union1d(self.user_codes, codes[is_new])
+        numpy.add.at(self.count_ugc, chunk.rows[is_new], 1)
+        numpy.add.at(self.count_words, chunk.rows[is_new], chunk.count_words[is_new])
+        new_entries = is_new[chunk.entry_posts]
+        numpy.add.at(self.scores, (chunk.rows[chunk.entry_posts[new_entries]], chunk.entry_categories[new_entries]),
+                     chunk.entry_values[new_entries])
 
+    def log_fractions(self):
+        """Scores of each grid cell with UGC as logged fractions of words that were in that category.
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("ugc_fn",
-                        help="File path of the CSV file containing UGC for the city.")
-    parser.add_argument("grid_geojson_fn",
-                        help="File path of the GeoJSON file containing the grid cells for the city.")
-    parser.add_argument("--first_ugc_only", action="store_true",
-                        help="Store only the first piece of UGC from a user for each grid cell.")
-    args = parser.parse_args()
+        Returns:
+            (cells, categories) array of scores - grid cells without UGC (or words) keep their summed scores
+        """
+        fractions = self.scores.copy()
+        has_words = (self.count_ugc > 0) & (self.count_words > 0)
+        fractions[has_words] = numpy.log(self.scores[has_words] / self.count_words[has_words, numpy.newaxis] + 1)
+        return fractions
 
-    lexicon = Empath()
+    def write_csv(self, csv_out_fn, grid_keys, fraction=True):
+        """Write the counts and scores of each grid cell to a CSV file.
+
+        Args:
+            csv_out_fn: path to output CSV
+            grid_keys: (rid, cid) of each grid cell in the order that they should be written
+            fraction: True if the scores of grid cells with UGC should be written as logged fractions of words (see
+                log_fractions) rather than counts
+        """
+        rows = numpy.array([self.rows[key] for key in grid_keys], dtype=numpy.int64).reshape(-1)
+        scores = self.log_fractions() if fraction else self.scores
+        as_floats = (self.count_ugc[rows] > 0) & fraction
+        float_scores = scores[rows].tolist()
+        int_scores = scores[rows].astype(numpy.int64).tolist()
+        count_ugc = self.count_ugc[rows].tolist()
+        count_words = self.count_words[rows].tolist()
+        with open(csv_out_fn, 'w') as fout:
+            csvwriter = csv.writer(fout)
+            csvwriter.writerow(['rid', 'cid', 'count_ugc', 'count_words'] + self.categories)
+            for i in range(0, len(rows)):
+                csvwriter.writerow([grid_keys[i][0], grid_keys[i][1], count_ugc[i], count_words[i]] +
+                                   (float_scores[i] if as_floats[i] else int_scores[i]))
+
+    def save(self, snapshot_fn, repo, fraction=True):
+        """Save the raw counts and user-dedup state to a NumPy .npz snapshot.
+
+        Args:
+            snapshot_fn: path to output snapshot
+            repo: UGC repository that was scored - either flickr, twitter, or crime
+            fraction: True if the scores should be written as logged fractions of words (see write_csv)
+        """
+        keys = numpy.array(self.keys, dtype=numpy.int64).reshape(-1, 2)
+        # dictionaries keep insertion order, which is the order of the user IDs
+        users = numpy.array(list(self.user_ids.keys()), dtype=str)
+        with open(snapshot_fn, 'wb') as fout:
+            numpy.savez_compressed(fout, rid=keys[:, 0], cid=keys[:, 1], categories=numpy.array(self.categories),
+                                   count_ugc=self.count_ugc, count_words=self.count_words, scores=self.scores,
+                                   users=users, user_codes=self.user_codes, repo=numpy.array(repo),
+                                   fraction=numpy.array(fraction), first_ugc_only=numpy.array(self.first_ugc_only))
+
+    @classmethod
+    def load(cls, snapshot_fn):
+        """Load a snapshot saved by save.
+
+        Returns:
+            grid_scores: GridScores with the snapshot's counts and user-dedup state
+            repo: UGC repository of the snapshot
+            fraction: True if the scores should be written as logged fractions of words
+        """
+        with numpy.load(snapshot_fn) as snapshot:
+            keys = list(zip(snapshot['rid'].tolist(), snapshot['cid'].tolist()))
+            grid_scores = cls(keys, snapshot['categories'].tolist(), bool(snapshot['first_ugc_only']))
+            grid_scores.count_ugc = snapshot['count_ugc']
+            grid_scores.count_words = snapshot['count_words']
+            grid_scores.scores = snapshot['scores']
+            users = snapshot['users'].tolist()
+            grid_scores.user_ids = {users[i]: i for i in range(0, len(users))}
+            grid_scores.user_codes = snapshot['user_codes']
+            return grid_scores, str(snapshot['repo']), bool(snapshot['fraction'])
+
+
+def grow_array(array, length):
+    """Copy of array extended with zeros to length rows."""
+    grown = numpy.zeros((length,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class ChunkScores(object):
+    """Scores of the UGC in one range of a UGC file, to be merged into GridScores.
+
+    Without first_ugc_only, the scores are summed for each grid cell with UGC in the range. With first_ugc_only,
+    the first UGC of each user in each grid cell in the range is kept separately (with only its non-zero category
+    scores) because whether it is the user's first UGC for the whole file depends on the earlier ranges.
+    """
+
+    def __init__(self, num_cells, num_categories, first_ugc_only=False):
+        self.first_ugc_only = first_ugc_only
+        self.users = []
+        self.seen = set()
+        self.batches = []
+        # grid cells with UGC in the range are given rows in the order they are first seen
+        self.local_rows = numpy.full(num_cells, -1, dtype=numpy.int64)
+        self.rows = numpy.empty(0, dtype=numpy.int64)
+        self.count_ugc = numpy.zeros(0, dtype=numpy.int64)
+        self.count_words = numpy.zeros(0, dtype=numpy.int64)
+        self.scores = numpy.zeros((0, num_categories), dtype=numpy.float64)
+
+    def select(self, rows, users):
+        """Indices of the UGC in a batch that should be counted (all of it unless first_ugc_only)."""
+        if not self.first_ugc_only:
+            return numpy.arange(len(rows))
+        selected = []
+        for i in range(0, len(rows)):
+            pair = (rows[i], users[i])
+            if pair not in self.seen:
+                self.seen.add(pair)
+                selected.append(i)
+        return numpy.array(selected, dtype=numpy.int64)
+
+    def add(self, rows, users, count_words, scores):
+        """Add a batch of scored UGC.
+
+        Args:
+            rows: GridScores row of the grid cell of each piece of UGC
+            users: user of each piece of UGC
+            count_words: number of words of each piece of UGC
+            scores: (len(rows), categories) array of category scores
+        """
+        if self.first_ugc_only:
+            self.users.extend(users)
+            posts, categories = numpy.nonzero(scores)
+            self.batches.append((rows, count_words, posts, categories, scores[posts, categories]))
+            return
+
+        new_rows = numpy.unique(rows[self.local_rows[rows] < 0])
+        if len(new_rows):
+            self.local_rows[new_rows] = numpy.arange(len(self.rows), len(self.rows) + len(new_rows))
+            self.rows = numpy.concatenate((self.rows, new_rows))
+            if len(self.rows) > len(self.count_ugc):
+                # grow the arrays to (at least) double their size to limit copying
+                capacity = max(len(self.rows), 2 * len(self.count_ugc))
+                self.count_ugc = grow_array(self.count_ugc, capacity)
+                self.count_words = grow_array(self.count_words, capacity)
+                self.scores = grow_array(self.scores, capacity)
+        local = self.local_rows[rows]
+        numpy.add.at(self.count_ugc, local, 1)
+        numpy.add.at(self.count_words, local, count_words)
+        numpy.add.at(self.scores, local, scores)
+
+    def finish(self):
+        """Combine the scored UGC into arrays once the whole range has been scored."""
+        self.seen = None
+        self.local_rows = None
+        if self.first_ugc_only:
+            offsets = numpy.cumsum([0] + [len(b[0]) for b in self.batches])
+            empty = [numpy.empty(0, dtype=numpy.int64)]
+            self.rows = numpy.concatenate([b[0] for b in self.batches] + empty)
+            self.count_words = numpy.concatenate([b[1] for b in self.batches] + empty)
+            self.entry_posts = numpy.concatenate([self.batches[i][2] + offsets[i]
+                                                  for i in range(0, len(self.batches))] + empty)
+            self.entry_categories = numpy.concatenate([b[3] for b in self.batches] + empty)
+            self.entry_values = numpy.concatenate([b[4] for b in self.batches] + [numpy.empty(0)])
+            self.batches = None
+        else:
+            self.count_ugc = self.count_ugc[:len(self.rows)]
+            self.count_words = self.count_words[:len(self.rows)]
+            self.scores = self.scores[:len(self.rows)]
+        return self
 
+
+def source_config(ugc_fn, lexicon):
+    """Determine the UGC repository and CSV layout of a UGC file from its name.
+
+    Returns:
+        dictionary with the repo, expected_header, column indices (ugc_idx, uid_idx, lat_idx, lon_idx, date_idx),
+        categories to score, whether the scores should be converted to fractions of words, and the date window
+        (first and last day as YYYYMMDD ints, or None to include all UGC) - see date_window
+    """
+    date_idx = None
+    window = None
     fraction = True
-    if 'flickr' in args.ugc_fn.lower():
+    if 'flickr' in ugc_fn.lower():
         expected_header = ['id', 'uid', 'user_tags', 'lat', 'lon']
         ugc_idx = expected_header.index('user_tags')  # tags applied to photo by user
         uid_idx = expected_header.index('uid')  # flickr user who uploaded photo
         repo = "flickr"
-        categories = lexicon.analyze("").keys()
-    elif 'twitter' in args.ugc_fn.lower() or 'tweets' in args.ugc_fn.lower():
+        categories = list(lexicon.analyze("").keys())
+    elif 'twitter' in ugc_fn.lower() or 'tweets' in ugc_fn.lower():
         expected_header = ['id', 'uid', 'text', 'lat', 'lon']
         ugc_idx = expected_header.index('text')  # tweet text
         uid_idx = expected_header.index('uid')  # twitter user who posted tweet
         repo = "twitter"
-        categories = lexicon.analyze("").keys()
-    elif 'crime' in args.ugc_fn.lower() or 'complaint' in args.ugc_fn.lower():
+        categories = list(lexicon.analyze("").keys())
+    elif 'crime' in ugc_fn.lower() or 'complaint' in ugc_fn.lower():
         repo = "crime"
-        if 'sf' in args.ugc_fn.lower():
+        if 'sf' in ugc_fn.lower():
             expected_header = ['IncidntNum', 'Category', 'Descript', 'DayOfWeek', 'Date',
                                'Time', 'PdDistrict', 'Resolution', 'Address', 'X', 'Y', 'Location']
-            date_idx = expected_header.index("Date")
+            date_idx = expected_header.index("Date")  # MM/DD/YYYY
             ugc_idx = expected_header.index("Category")
             uid_idx = expected_header.index("IncidntNum")
             categories = ['assault', 'vehicle theft', 'kidnapping', 'drug/narcotic', 'weapon laws',
                           'sex offenses, forcible']
-        elif 'nyc' in args.ugc_fn.lower():
+        elif 'nyc' in ugc_fn.lower():
             expected_header = ['CMPLNT_NUM', 'CMPLNT_FR_DT', 'CMPLNT_FR_TM', 'CMPLNT_TO_DT', 'CMPLNT_TO_TM', 'RPT_DT',
                                'KY_CD', 'OFNS_DESC', 'PD_CD', 'PD_DESC', 'CRM_ATPT_CPTD_CD', 'LAW_CAT_CD', 'JURIS_DESC',
                                'BORO_NM', 'ADDR_PCT_CD', 'LOC_OF_OCCUR_DESC', 'PREM_TYP_DESC', 'PARKS_NM', 'HADEVELOPT',
                                'X_COORD_CD', 'Y_COORD_CD', 'lat', 'lon', 'Lat_Lon']
-            date_idx = expected_header.index("CMPLNT_TO_DT")
+            date_idx = expected_header.index("CMPLNT_TO_DT")  # MM/DD/YYYY
             ugc_idx = expected_header.index("OFNS_DESC")
             uid_idx = expected_header.index("CMPLNT_NUM")
             categories = ['assault 3 & related offenses', 'grand larceny', 'dangerous drugs', 'felony assault',
                           'grand larceny of motor vehicle', 'dangerous weapons', 'kidnapping & related offenses']
         fraction = False
+        window = date_window(*CRIME_DATE_WINDOW)
     else:
         raise Exception("source not recognized - must have 'flickr', 'twitter', 'crime' or 'complaint' in filename")
     try:
@@ -144,10 +562,336 @@ def main():
     except ValueError:
         lat_idx = expected_header.index('Y')
         lon_idx = expected_header.index('X')
-    print("Analyzing {0} and {1}.".format(args.ugc_fn, args.grid_geojson_fn))
+    return {'repo': repo, 'expected_header': expected_header, 'ugc_idx': ugc_idx, 'uid_idx': uid_idx,
+            'lat_idx': lat_idx, 'lon_idx': lon_idx, 'date_idx': date_idx, 'categories': categories,
+            'fraction': fraction, 'date_window': window}
+
+
+def date_window(start_date, end_date):
+    """Convert the first and last day (YYYY-MM-DD, inclusive) of a date window to YYYYMMDD ints."""
+    return int(start_date.replace("-", "")), int(end_date.replace("-", ""))
+
+
+def parse_dates(values):
+    """Parse MM/DD/YYYY dates (anything after the first ten characters, e.g. a time, is ignored).
+
+    Returns:
+        array of the dates as YYYYMMDD ints, with 0 for values that are not dates
+    """
+    # unicode code point of each of the first ten characters of each value
+    chars = numpy.array(values, dtype='U10').view(numpy.uint32).reshape(len(values), 10).astype(numpy.int64)
+    digits = chars - ord('0')
+    digit_cols = [0, 1, 3, 4, 6, 7, 8, 9]
+    valid = numpy.all((digits[:, digit_cols] >= 0) & (digits[:, digit_cols] <= 9), axis=1)
+    valid &= (chars[:, 2] == ord('/')) & (chars[:, 5] == ord('/'))
+    month = digits[:, 0] * 10 + digits[:, 1]
+    day = digits[:, 3] * 10 + digits[:, 4]
+    year = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+    return numpy.where(valid, year * 10000 + month * 100 + day, 0)
+
+
+def parse_coords(values):
+    """Parse a column of coordinates.
+
+    Returns:
+        coords: float array of the coordinates (NaN where missing)
+        has_coord: boolean array of whether each value is a number
+    """
+    values = numpy.array(values, dtype=str)
+    coords = numpy.full(len(values), numpy.nan)
+    # blank coordinates are common (e.g. crimes anonymized by the police department), so only those are skipped
+    # before falling back to parsing each value
+    has_coord = values != ''
+    try:
+        coords[has_coord] = values[has_coord].astype(numpy.float64)
+    except ValueError:
+        for i in numpy.flatnonzero(has_coord):
+            try:
+                coords[i] = float(values[i])
+            except ValueError:
+                has_coord[i] = False
+    return coords, has_coord
+
+
+def ugc_chunks(ugc_fn, num_chunks):
+    """Split a CSV file into byte ranges of roughly equal size that each start at the beginning of a record.
 
-    # Load in grid cells
-    with open(args.grid_geojson_fn, 'r') as fin:
+    Quoted fields may contain newlines (e.g. tweet text), so a range only ends after a line at which all quotes
+    seen so far are closed.
+
+    Returns:
+        list of (start, end) byte offsets covering every record after the header
+    """
+    size = os.path.getsize(ugc_fn)
+    with open(ugc_fn, 'rb') as fin:
+        position = len(fin.readline())
+        offsets = [position]
+        if num_chunks > 1:
+            chunk_size = max(1, (size - position) // num_chunks)
+            quotes = 0
+            for line in fin:
+                position += len(line)
+                quotes += line.count(b'"')
+                if position - offsets[-1] >= chunk_size and quotes % 2 == 0 and position < size:
+                    offsets.append(position)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_lines(ugc_fn, start, end):
+    """Generator of the lines of a file in the byte range [start, end)."""
+    with open(ugc_fn, 'rb') as fin:
+        fin.seek(start)
+        position = start
+        for line in fin:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def window_prefilter(window):
+    """Regex that matches every MM/DD/YYYY date within a date window (and some dates outside of it)."""
+    years = range(window[0] // 10000, window[1] // 10000 + 1)
+    return re.compile("/(?:{0})".format("|".join(str(year) for year in years)).encode('utf-8'))
+
+
+def prefilter_records(data, prefilter):
+    """Keep only the CSV records in data (which must end at the end of a record) that match the prefilter regex.
+
+    Records end at newlines at which all quotes seen so far are closed (see ugc_chunks), which are found with NumPy
+    so that records that do not match are dropped without being parsed.
+    """
+    chars = numpy.frombuffer(data, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(chars == ord('\n'))
+    quotes = numpy.cumsum(chars == ord('"'))
+    ends = newlines[quotes[newlines] % 2 == 0] + 1
+    if not len(ends) or ends[-1] != len(data):
+        ends = numpy.append(ends, len(data))
+    starts = numpy.concatenate(([0], ends[:-1]))
+    matches = numpy.array([match.start() for match in prefilter.finditer(data)], dtype=numpy.int64)
+    matched = numpy.unique(numpy.searchsorted(ends, matches, side='right')).tolist()
+    starts = starts.tolist()
+    ends = ends.tolist()
+    return b''.join([data[starts[i]:ends[i]] for i in matched])
+
+
+def read_blocks(ugc_fn, start, end, prefilter=None, block_bytes=INGEST_BLOCK_BYTES):
+    """Generator of blocks of parsed CSV rows in the byte range [start, end) of a file.
+
+    Each block is read with a single read of (about) block_bytes, extended to the end of a record (see ugc_chunks),
+    and parsed at once. If a prefilter regex is given, records that do not match it are not parsed or returned.
+    """
+    with open(ugc_fn, 'rb') as fin:
+        fin.seek(start)
+        position = start
+        while position < end:
+            data = fin.read(min(block_bytes, end - position))
+            quotes = data.count(b'"')
+            while position + len(data) < end and (not data.endswith(b'\n') or quotes % 2):
+                line = fin.readline()
+                quotes += line.count(b'"')
+                data += line
+            position += len(data)
+            if prefilter is not None:
+                data = prefilter_records(data, prefilter)
+            yield list(csv.reader(io.StringIO(data.decode('utf-8'), newline='')))
+
+
+def filter_block(block, source, bounds):
+    """Find the rows of a block of a UGC file that are within the date window and bounding box.
+
+    Coordinates are only parsed for rows within the date window.
+
+    Args:
+        block: list of CSV rows
+        source: UGC file layout from source_config
+        bounds: (minx, miny, maxx, maxy) of the grid - UGC on or outside of its edges is skipped
+
+    Returns:
+        rows: indices of the rows within the date window
+        ys, xs: coordinates of each of those rows (NaN where missing)
+        has_coords: boolean array of whether each of those rows has x-y coords
+        in_bounds: boolean array of whether each of those rows is within the bounding box
+    """
+    if source['date_window'] is not None:
+        dates = parse_dates([line[source['date_idx']] for line in block])
+        rows = numpy.flatnonzero((dates >= source['date_window'][0]) & (dates <= source['date_window'][1]))
+    else:
+        rows = numpy.arange(len(block))
+    ys, has_y = parse_coords([block[i][source['lat_idx']] for i in rows])
+    xs, has_x = parse_coords([block[i][source['lon_idx']] for i in rows])
+    in_bounds = (xs > bounds[0]) & (ys > bounds[1]) & (xs < bounds[2]) & (ys < bounds[3])
+    return rows, ys, xs, has_y & has_x, in_bounds
+
+
+def ugc_vocabulary(ugc_fn, source):
+    """Set of all words to be lemmatized in a UGC file (see ugc_words)."""
+    vocabulary = set()
+    start, end = ugc_chunks(ugc_fn, 1)[0]
+    for line in csv.reader(read_lines(ugc_fn, start, end)):
+        try:
+            vocabulary.update(ugc_words(line[source['ugc_idx']], source['repo']))
+        except IndexError:
+            continue
+    return vocabulary
+
+
+def score_ugc_batch(ugcs, lexicon, repo, categories):
+    """Score a batch of UGC.
+
+    Args:
+        ugcs: list of preprocessed UGC - lists of tags or words depending on repository
+        lexicon: CompiledLexicon of the categories for flickr or twitter (unused for crime)
+        repo: UGC repository - either flickr, twitter, or crime
+        categories: Empath categories (or crime categories) to include in analysis
+
+    Returns:
+        count_words: array of the number of words in each piece of UGC (or 1 for crimes in one of the categories)
+        scores: (len(ugcs), len(categories)) array of the score of each piece of UGC for each category
+    """
+    if repo == 'twitter' or repo == 'flickr':
+        return numpy.array([len(ugc) for ugc in ugcs], dtype=numpy.int64), lexicon.score(ugcs)
+    elif repo == "crime":
+        category_idx = {categories[k]: k for k in range(0, len(categories))}
+        count_words = numpy.zeros(len(ugcs), dtype=numpy.int64)
+        scores = numpy.zeros((len(ugcs), len(categories)), dtype=numpy.float64)
+        for i in range(0, len(ugcs)):
+            k = category_idx.get(ugcs[i])
+            if k is not None:
+                count_words[i] = 1
+                scores[i, k] = 1
+        return count_words, scores
+    else:
+        raise ValueError("Do not recognize repo {0}.".format(repo))
+
+
+def score_batch(batch, grid_index, lexicon, repo, categories, chunk_scores, stats):
+    """Find the grid cells containing a batch of UGC and score each piece of UGC (in order) for its grid cell.
+
+    Args:
+        batch: list of (lat, lon, preprocessed UGC, userID)
+        lexicon: CompiledLexicon of the categories (for flickr or twitter)
+        chunk_scores, stats: updated with the batch - see score_chunk
+    """
+    cell_idx, first_try = grid_index.locate([b[0] for b in batch], [b[1] for b in batch])
+    stats['points_analyzed'] += len(batch)
+    stats['found_first_try'] += int(numpy.count_nonzero(first_try))
+    stats['not_found'] += int(numpy.count_nonzero(cell_idx < 0))
+
+    located = numpy.flatnonzero(cell_idx >= 0)
+    rows = cell_idx[located]
+    users = [batch[i][3] for i in located]
+    # only the UGC that will be counted is scored
+    selected = chunk_scores.select(rows, users)
+    count_words, scores = score_ugc_batch([batch[located[i]][2] for i in selected], lexicon, repo, categories)
+    chunk_scores.add(rows[selected], [users[i] for i in selected], count_words, scores)
+
+
+def print_progress(stats):
+    print("{points_analyzed} points analyzed: {found_first_try} found first try, {not_found} not found, "
+          "{points_skipped} skipped and {no_lat_lon} missing x-y coords.".format(**stats))
+
+
+def score_chunk(ugc_fn, start, end, source, grid_index, county_bb, lexicon, lemmatizer, first_ugc_only=False,
+                verbose=True):
+    """Score the UGC in one byte range of a UGC file for the grid cells that contain it.
+
+    Args:
+        ugc_fn: path to UGC CSV
+        start, end: byte range of the file to score (see ugc_chunks)
+        source: UGC file layout from source_config
+        grid_index: GridIndex of the grid cells (its cell indices are the GridScores rows)
+        county_bb: bounding box of the grid - UGC outside of it (or outside of the source's date window) is skipped
+        lexicon: CompiledLexicon of the categories (for flickr or twitter)
+        lemmatizer: lemmatizer object to be used
+        first_ugc_only: if True, only include first post from any user for a cell
+        verbose: if True, print progress after each batch of UGC
+
+    Returns:
+        chunk_scores: ChunkScores of the range, to be merged into GridScores in the order of the ranges
+        stats: dictionary of the number of points analyzed, found in their first try, not found, skipped, and
+            missing coordinates
+    """
+    repo = source['repo']
+    categories = source['categories']
+    stats = {'points_analyzed': 0, 'found_first_try': 0, 'not_found': 0, 'points_skipped': 0, 'no_lat_lon': 0}
+    chunk_scores = ChunkScores(len(grid_index.keys), len(categories), first_ugc_only)
+    bounds = county_bb.bounds
+    prefilter = None
+    if source['date_window'] is not None:
+        # most crimes are outside of the date window, so those are dropped before parsing the CSV
+        prefilter = window_prefilter(source['date_window'])
+    batch = []
+    for block in read_blocks(ugc_fn, start, end, prefilter):
+        rows, ys, xs, has_coords, in_bounds = filter_block(block, source, bounds)
+        no_coords = numpy.flatnonzero(~has_coords)
+        stats['no_lat_lon'] += len(no_coords)
+        stats['points_skipped'] += int(numpy.count_nonzero(has_coords & ~in_bounds))
+        if repo != 'crime':  # some crimes have no lat-lon for anonymity or lack of data
+            for i in no_coords:
+                print("Invalid x-y coords: {0}".format(block[rows[i]]))
+
+        # only rows within the date window and bounding box are preprocessed
+        for i in numpy.flatnonzero(has_coords & in_bounds):
+            line = block[rows[i]]
+            try:
+                ugc = preprocess_ugc(line[source['ugc_idx']], repo, lemmatizer)
+            except ValueError:
+                stats['no_lat_lon'] += 1
+                traceback.print_exc()
+                print(line)
+                continue
+            batch.append((ys[i], xs[i], ugc, line[source['uid_idx']]))
+            if len(batch) == BATCH_SIZE:
+                score_batch(batch, grid_index, lexicon, repo, categories, chunk_scores, stats)
+                batch = []
+                if verbose:
+                    print_progress(stats)
+    if batch:
+        score_batch(batch, grid_index, lexicon, repo, categories, chunk_scores, stats)
+
+    return chunk_scores.finish(), stats
+
+
+_worker_state = {}
+
+
+def init_worker(ugc_fn, source, grid_index, county_bb, lexicon, lemma_vocabulary, first_ugc_only):
+    lemmatizer = CachedLemmatizer(WordNetLemmatizer(), vocabulary=lemma_vocabulary)
+    _worker_state['args'] = (source, grid_index, county_bb, lexicon, lemmatizer)
+    _worker_state['ugc_fn'] = ugc_fn
+    _worker_state['first_ugc_only'] = first_ugc_only
+
+
+def score_chunk_in_worker(chunk):
+    source, grid_index, county_bb, lexicon, lemmatizer = _worker_state['args']
+    return score_chunk(_worker_state['ugc_fn'], chunk[0], chunk[1], source, grid_index, county_bb, lexicon,
+                       lemmatizer, _worker_state['first_ugc_only'], verbose=False)
+
+
+def load_grid(grid_fn):
+    """Load grid cells from a grid GeoJSON file or a raster grid (.npz) from grid_creation.py.
+
+    Returns:
+        grid_keys: (rid, cid) of each grid cell in the order of the file
+        grid_index: GridIndex of the grid cells
+        county_bb: bounding box that contains all of the grid cells
+    """
+    if grid_fn.endswith(".npz"):
+        # raster grid cells are boxes with the same bounds as their GeoJSON polygons, so there is no geometry to parse
+        raster = RasterGrid.load(grid_fn)
+        grid_keys = raster.keys()
+        bounds = raster.bounds()
+        grid_shapes = dict(zip(grid_keys, [box(*cell_bounds) for cell_bounds in bounds.tolist()]))
+        bb_south = bounds[:, 1].min()  # miny
+        bb_north = bounds[:, 3].max()  # maxy
+        bb_east = bounds[:, 0].max()  # maxx
+        bb_west = bounds[:, 2].min()  # minx
+        county_bb = box(bb_west, bb_south, bb_east, bb_north)
+        return grid_keys, GridIndex(list(grid_shapes.keys()), list(grid_shapes.values())), county_bb
+
+    with open(grid_fn, 'r') as fin:
         grid = json.load(fin)
 
     # Load in grid cells and compute bounding box that contains all of them
@@ -155,7 +899,8 @@ def main():
     bb_north = float("-Inf")
     bb_east = float("-Inf")
     bb_west = float("Inf")
-    gridcells = {}
+    grid_keys = []
+    grid_shapes = {}
     for gridcell in grid['features']:
         rid = gridcell['properties']['rid']
         cid = gridcell['properties']['cid']
@@ -165,95 +910,100 @@ def main():
         bb_north = max(bb_north, grid_bb[3])  # maxy
         bb_east = max(bb_east, grid_bb[0])  # maxx
         bb_west = min(bb_west, grid_bb[2])  # minx
-        gridcells[(rid, cid)] = {'rid': rid, 'cid': cid, 'shape': grid_shape, 'count_ugc': 0, 'count_words': 0,
-                                 'users': set()}
-        for cat in categories:
-            gridcells[(rid, cid)][cat] = 0
-
-    keyset = list(gridcells[(rid, cid)].keys())
-    for cat_to_not_output in ['users', 'shape']:
-        keyset.remove(cat_to_not_output)
+        grid_keys.append((rid, cid))
+        grid_shapes[(rid, cid)] = grid_shape
 
     # if UGC or crime data outside of this, then it can be skipped
     county_bb = box(bb_west, bb_south, bb_east, bb_north)
+    return grid_keys, GridIndex(list(grid_shapes.keys()), list(grid_shapes.values())), county_bb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ugc_fn",
+                        help="File path of the CSV file containing UGC for the city.")
+    parser.add_argument("grid_geojson_fn",
+                        help="File path of the GeoJSON file (or raster grid .npz) containing the grid cells for the "
+                             "city.")
+    parser.add_argument("--first_ugc_only", action="store_true",
+                        help="Store only the first piece of UGC from a user for each grid cell.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that score chunks of the UGC file in parallel.")
+    parser.add_argument("--chunks_per_worker", type=int, default=4,
+                        help="Number of chunks the UGC file is split into per worker.")
+    parser.add_argument("--prelemmatize", action="store_true",
+                        help="Lemmatize the vocabulary of the UGC file up front and share it with all workers.")
+    parser.add_argument("--start_date", default=CRIME_DATE_WINDOW[0],
+                        help="First day (YYYY-MM-DD) of crimes to include.")
+    parser.add_argument("--end_date", default=CRIME_DATE_WINDOW[1],
+                        help="Last day (YYYY-MM-DD) of crimes to include.")
+    parser.add_argument("--snapshot_fn", default=None,
+                        help="File path of the raw-count snapshot (default: next to the output CSV).")
+    parser.add_argument("--update", action="store_true",
+                        help="Fold the UGC into the existing snapshot instead of scoring from scratch.")
+    args = parser.parse_args()
+
+    lexicon = Empath()
+
+    source = source_config(args.ugc_fn, lexicon)
+    if source['date_idx'] is not None:
+        source['date_window'] = date_window(args.start_date, args.end_date)
+        print("Including crimes from {0} to {1}.".format(args.start_date, args.end_date))
+    repo = source['repo']
+    categories = source['categories']
+    print("Analyzing {0} and {1}.".format(args.ugc_fn, args.grid_geojson_fn))
+
+    grid_keys, grid_index, county_bb = load_grid(args.grid_geojson_fn)
 
     # Process UGC
-    points_analyzed = 0
-    found_first_try = 0
-    points_skipped = 0
-    no_lat_lon = 0
-    not_found = 0
-    lemmatizer = WordNetLemmatizer()
-    adj_idx = [0, 1, -1, 2, -2, 3, -3]
+    compiled_lexicon = None
+    if repo == 'twitter' or repo == 'flickr':
+        compiled_lexicon = CompiledLexicon(lexicon, categories)
+    snapshot_fn = args.snapshot_fn
+    if snapshot_fn is None:
+        snapshot_fn = os.path.splitext(args.grid_geojson_fn)[0] + "_{0}_snapshot.npz".format(repo)
+    if args.update:
+        grid_scores, snapshot_repo, snapshot_fraction = GridScores.load(snapshot_fn)
+        if snapshot_repo != repo or grid_scores.keys != grid_index.keys or grid_scores.categories != categories:
+            raise ValueError("Snapshot {0} is not of {1} UGC for this grid.".format(snapshot_fn, repo))
+        if grid_scores.first_ugc_only != args.first_ugc_only:
+            raise ValueError("Snapshot {0} was made with first_ugc_only={1}.".format(snapshot_fn,
+                                                                                   grid_scores.first_ugc_only))
+        print("Updating {0}: {1} pieces of UGC so far.".format(snapshot_fn, grid_scores.count_ugc.sum()))
+    else:
+        grid_scores = GridScores(grid_index.keys, categories, args.first_ugc_only)
+    lemmatizer = CachedLemmatizer(WordNetLemmatizer())
+    if args.prelemmatize and (repo == 'twitter' or repo == 'flickr'):
+        lemmatizer.prelemmatize(ugc_vocabulary(args.ugc_fn, source))
+        print("Lemmatized vocabulary of {0} words.".format(len(lemmatizer.vocabulary)))
     with open(args.ugc_fn, 'r') as fin:
-        csvreader = csv.reader(fin)
-        assert next(csvreader) == expected_header
-        for line in csvreader:
-            try:
-                # crime must have been committed in past year
-                if repo == 'crime' and "2016" not in line[date_idx]:
-                    continue
-                y = float(line[lat_idx])
-                x = float(line[lon_idx])
-                pt = point.Point(x, y)
-                if not county_bb.contains(pt):
-                    points_skipped += 1
-                    continue
-                ugc = preprocess_ugc(line[ugc_idx], repo, lemmatizer)
-            except ValueError:
-                no_lat_lon += 1
-                if repo != 'crime':  # some crimes have no lat-lon for anonymity or lack of data
-                    traceback.print_exc()
-                    print(line)
-
-            found = False
-            user = line[uid_idx]
-            best_guess = (floor(y * 10 ** SCALE), floor(x * 10 ** SCALE))  # likely grid cell containing data
-            for i in adj_idx:  # try best guess and then three grid cells to either side
-                for j in adj_idx:
-                    try:
-                        if gridcells[(best_guess[0] + i, best_guess[1] + j)]['shape'].contains(pt):
-                            analyze_ugc(gridcells, (best_guess[0] + i, best_guess[1] + j), ugc, user, lexicon, repo,
-                                        categories, args.first_ugc_only)
-                            found = True
-                            break
-                    except KeyError:
-                        continue
-                if found:
-                    break
-            if not found:
-                not_found += 1
-            else:
-                if i == 0 and j == 0:
-                    found_first_try += 1
-            points_analyzed += 1
-            if points_analyzed % 10000 == 0:
-                print("{0} points analyzed: {1} found first try, {2} not found, {3} skipped "
-                      "and {4} missing x-y coords.".format(points_analyzed, found_first_try,
-                                                           not_found, points_skipped, no_lat_lon))
-
-    # All UGC processed, convert counts to logged fractions of words that were in that category
-    if fraction:
-        for gc in gridcells:
-            if gridcells[gc]['count_ugc'] > 0:
-                if gridcells[gc]['count_words'] > 0:
-                    for cat in categories:
-                        fraction_cat = gridcells[gc][cat] / gridcells[gc]['count_words']
-                        gridcells[gc][cat] = numpy.log(fraction_cat + 1)
-
-    # Dump output to CSV
-    csv_out_fn = args.grid_geojson_fn.replace(".geojson", "_{0}_empath.csv".format(repo))
-    with open(csv_out_fn, 'w') as fout:
-        csvwriter = csv.DictWriter(fout, fieldnames=keyset, extrasaction="ignore")
-        csvwriter.writeheader()
-        for gc in grid['features']:
-            rid = gc['properties']['rid']
-            cid = gc['properties']['cid']
-            gc['properties']['count_ugc'] = gridcells[(rid, cid)]['count_ugc']
-            gc['properties']['count_words'] = gridcells[(rid, cid)]['count_words']
-            for cat in categories:
-                gc['properties'][cat] = gridcells[(rid, cid)][cat]
-            csvwriter.writerow(gc['properties'])
+        assert next(csv.reader(fin)) == source['expected_header']
+    stats = {'points_analyzed': 0, 'found_first_try': 0, 'not_found': 0, 'points_skipped': 0, 'no_lat_lon': 0}
+    if args.workers > 1:
+        chunks = ugc_chunks(args.ugc_fn, args.workers * args.chunks_per_worker)
+        print("Scoring {0} chunks with {1} workers.".format(len(chunks), args.workers))
+        with Pool(processes=args.workers, initializer=init_worker,
+                  initargs=(args.ugc_fn, source, grid_index, county_bb, compiled_lexicon,
+                            lemmatizer.vocabulary, args.first_ugc_only)) as pool:
+            # imap returns the chunks in order, which GridScores.merge relies on
+            for chunk_scores, chunk_stats in pool.imap(score_chunk_in_worker, chunks):
+                grid_scores.merge(chunk_scores)
+                for stat in stats:
+                    stats[stat] += chunk_stats[stat]
+                print_progress(stats)
+    else:
+        start, end = ugc_chunks(args.ugc_fn, 1)[0]
+        chunk_scores, stats = score_chunk(args.ugc_fn, start, end, source, grid_index, county_bb, compiled_lexicon,
+                                          lemmatizer, args.first_ugc_only)
+        grid_scores.merge(chunk_scores)
+        print_progress(stats)
+
+    # All UGC processed, keep the raw counts so that more UGC can be added later (--update)
+    grid_scores.save(snapshot_fn, repo, fraction=source['fraction'])
+
+    # Dump output to CSV, with counts converted to logged fractions of words that were in that category
+    csv_out_fn = os.path.splitext(args.grid_geojson_fn)[0] + "_{0}_empath.csv".format(repo)
+    grid_scores.write_csv(csv_out_fn, grid_keys, fraction=source['fraction'])
 
 
 if __name__ == "__main__":
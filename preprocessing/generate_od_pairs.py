@@ -4,10 +4,13 @@ import json
 from random import random, randint
 from math import floor
 
+import numpy
 from geopy.distance import vincenty
 from geopy.distance import great_circle
 from shapely.geometry import shape, Point
 
+from grid_creation import load_grid_cells
+
 ODPAIRS_PER_CITY = 5000
 OUTPUT_HEADER = ["ID", "origin_lon", "origin_lat", "destination_lon", "destination_lat", "straight_line_distance"]
 
@@ -74,7 +77,7 @@ def odpairs_from_grid_centroids(input_geojson_fns, output_csv_fn, min_dist=0, ma
     """Randomly select origin-destination pairs from combinations of grid cells.
 
     Args:
-        input_geojsons_fns: list of geojson files containing gridcells
+        input_geojsons_fns: list of geojson files (or raster grid .npz files) containing gridcells
         output_csv_fn: path to output CSV file for od-pairs
         min_dist: only include od-pairs with a Euclidean distance greater than this threshold (km)
         max_dist: only include od-pairs with a Euclidean distance under this threshold (km)
@@ -83,16 +86,14 @@ def odpairs_from_grid_centroids(input_geojson_fns, output_csv_fn, min_dist=0, ma
         Void. Writes output origin-destination pairs along with straight-line distance to CSV file
     """
 
-    #open/load grid geojson
+    #open/load grid geojson (or raster grids)
+    keys, bounds = load_grid_cells(input_geojson_fns)
+    # grid cells are rectangles, so their centroids are the centers of their bounds
+    centroids = numpy.column_stack(((bounds[:, 1] + bounds[:, 3]) / 2, (bounds[:, 0] + bounds[:, 2]) / 2)).tolist()
     gridcells = []
-    for geojson_fn in input_geojson_fns:
-        with open(geojson_fn, 'r') as fin:
-          gridcells.extend(json.load(fin)['features'])
-
-    for feature in gridcells:
-        feature['centroid'] = (shape(feature['geometry']).centroid.y, shape(feature['geometry']).centroid.x)
-        feature['properties']['rid'] = str(feature['properties']['rid'])
-        feature['properties']['cid'] = str(feature['properties']['cid'])
+    for i in range(0, len(keys)):
+        gridcells.append({'centroid': tuple(centroids[i]),
+                          'properties': {'rid': str(keys[i][0]), 'cid': str(keys[i][1])}})
 
     if secondary_geojson:
         with open(secondary_geojson, 'r') as fin:
@@ -2,9 +2,11 @@ import os
 import json
 import argparse
 from math import ceil, floor
+from multiprocessing import Pool
 
-from geojson import Polygon, Feature, FeatureCollection, dump
-from shapely.geometry import shape, Point
+import numpy
+from shapely import contains_xy, prepare
+from shapely.geometry import shape
 
 """
 Code adapted from answer to question here:
@@ -14,8 +16,76 @@ http://gis.stackexchange.com/questions/54119/creating-square-grid-polygon-shapef
 # Output directory for the county geojson grids
 GRIDS_DIR = "data/grids/"
 SCALE = 3
+# decimal places of grid cell coordinates
+COORD_PRECISION = 6
+# number of columns of grid cells that are tested against the boundary at once
+COLUMN_BLOCK_SIZE = 256
+FEATURE_TEMPLATE = ('{{"type": "Feature", "geometry": {{"type": "Polygon", "coordinates": [[[{0}, {1}], [{2}, {3}], '
+                    '[{4}, {5}], [{6}, {7}], [{8}, {9}]]]}}, "properties": {{"rid": {10}, "cid": {11}}}}}')
 
-def grid(outputGridfn, xmin, xmax, ymin, ymax, gridHeight, gridWidth, boundary):
+class RasterGrid(object):
+    """Compact grid: the origin and resolution of a county's lattice of grid cells plus the cells that are in the
+    county, which is much smaller and faster to load than a GeoJSON polygon for every grid cell.
+
+    Attributes:
+        xmin, ymin: coordinates of the bottom-left corner of the lattice
+        grid_width, grid_height: size of each column and row of the lattice in degrees
+        rows, cols: number of rows and columns in the lattice
+        col_idx, row_idx: column and row of each grid cell, in the order of the GeoJSON features
+    """
+
+    def __init__(self, xmin, ymin, grid_width, grid_height, rows, cols, col_idx, row_idx):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.rows = rows
+        self.cols = cols
+        self.col_idx = col_idx
+        self.row_idx = row_idx
+
+    @property
+    def grid_x_left(self):
+        return self.xmin + numpy.arange(self.cols) * self.grid_width
+
+    @property
+    def grid_y_bottom(self):
+        return self.ymin + numpy.arange(self.rows) * self.grid_height
+
+    def keys(self):
+        """(rid, cid) of each grid cell."""
+        rids = [round(y * 10**SCALE) for y in self.grid_y_bottom.tolist()]
+        cids = [round(x * 10**SCALE) for x in self.grid_x_left.tolist()]
+        return [(rids[j], cids[i]) for i, j in zip(self.col_idx.tolist(), self.row_idx.tolist())]
+
+    def bounds(self):
+        """(cells, 4) array of the minx, miny, maxx, maxy of each grid cell (the same as the GeoJSON polygons)."""
+        x_left = numpy.array([round(x, COORD_PRECISION) for x in self.grid_x_left.tolist()])
+        x_right = numpy.array([round(x + 0.001, COORD_PRECISION) for x in self.grid_x_left.tolist()])
+        y_bottom = numpy.array([round(y, COORD_PRECISION) for y in self.grid_y_bottom.tolist()])
+        y_top = numpy.array([round(y + 0.001, COORD_PRECISION) for y in self.grid_y_bottom.tolist()])
+        return numpy.column_stack((x_left[self.col_idx], y_bottom[self.row_idx], x_right[self.col_idx],
+                                   y_top[self.row_idx])).reshape(-1, 4)
+
+    def write_geojson(self, geojson_fn):
+        with open(geojson_fn, 'w') as fout:
+            write_grid_geojson(fout, self.grid_x_left, self.grid_y_bottom, self.col_idx, self.row_idx)
+
+    def save(self, raster_fn):
+        with open(raster_fn, 'wb') as fout:
+            numpy.savez_compressed(fout, xmin=self.xmin, ymin=self.ymin, grid_width=self.grid_width,
+                                   grid_height=self.grid_height, rows=self.rows, cols=self.cols,
+                                   col_idx=self.col_idx.astype(numpy.int32), row_idx=self.row_idx.astype(numpy.int32))
+
+    @classmethod
+    def load(cls, raster_fn):
+        with numpy.load(raster_fn) as raster:
+            return cls(float(raster['xmin']), float(raster['ymin']), float(raster['grid_width']),
+                       float(raster['grid_height']), int(raster['rows']), int(raster['cols']),
+                       raster['col_idx'].astype(numpy.int64), raster['row_idx'].astype(numpy.int64))
+
+
+def grid(outputGridfn, xmin, xmax, ymin, ymax, gridHeight, gridWidth, boundary, grid_format="geojson"):
 
     # check all floats
     xmin = float(xmin)
@@ -30,76 +100,159 @@ def grid(outputGridfn, xmin, xmax, ymin, ymax, gridHeight, gridWidth, boundary):
     # get columns
     cols = ceil((xmax - xmin) / gridWidth)
 
-    # create grid cells
-    countcols = 0
+    grid_x_left, grid_y_bottom, col_idx, row_idx = grid_cells(xmin, ymin, rows, cols, gridHeight, gridWidth,
+                                                              boundary)
+    raster = RasterGrid(xmin, ymin, gridWidth, gridHeight, rows, cols, col_idx, row_idx)
+    if grid_format in ("geojson", "both"):
+        raster.write_geojson(outputGridfn)
+    if grid_format in ("raster", "both"):
+        raster.save(os.path.splitext(outputGridfn)[0] + ".npz")
+    return raster
+
+
+def load_grid_cells(grid_fns):
+    """Load the grid cells of grid GeoJSON and/or raster grid (.npz) files.
+
+    Returns:
+        keys: list of (rid, cid) of each grid cell in the order of the files
+        bounds: (cells, 4) array of the minx, miny, maxx, maxy of each grid cell
+    """
+    keys = []
+    bounds = []
+    for grid_fn in grid_fns:
+        if grid_fn.endswith(".npz"):
+            raster = RasterGrid.load(grid_fn)
+            keys.extend(raster.keys())
+            bounds.append(raster.bounds())
+        else:
+            with open(grid_fn, 'r') as fin:
+                features = json.load(fin)['features']
+            keys.extend((f['properties']['rid'], f['properties']['cid']) for f in features)
+            bounds.append(numpy.array([shape(f['geometry']).bounds for f in features]).reshape(-1, 4))
+    return keys, numpy.concatenate(bounds + [numpy.empty((0, 4))])
+
+
+def grid_cells(xmin, ymin, rows, cols, gridHeight, gridWidth, boundary):
+    """Find the grid cells with any corner in the boundary.
+
+    All corners of a block of columns are tested against the prepared boundary at once.
+
+    Returns:
+        grid_x_left: x coordinate of the left edge of each column
+        grid_y_bottom: y coordinate of the bottom edge of each row
+        col_idx, row_idx: column and row of each grid cell in the boundary, ordered by column and then row
+    """
+    prepare(boundary)
+    # same arithmetic as stepping through the columns and rows one at a time
+    grid_x_left = xmin + numpy.arange(cols) * gridWidth
+    grid_y_bottom = ymin + numpy.arange(rows) * gridHeight
+    grid_x_right = grid_x_left + 0.001
+    grid_y_top = grid_y_bottom + 0.001
+
+    col_idx = []
+    row_idx = []
+    for start in range(0, cols, COLUMN_BLOCK_SIZE):
+        block = slice(start, min(start + COLUMN_BLOCK_SIZE, cols))
+        left = grid_x_left[block, numpy.newaxis]
+        right = grid_x_right[block, numpy.newaxis]
+        # a grid cell is included if any of its corners is contained in the boundary
+        included = (contains_xy(boundary, left, grid_y_top) | contains_xy(boundary, right, grid_y_top) |
+                    contains_xy(boundary, right, grid_y_bottom) | contains_xy(boundary, left, grid_y_bottom))
+        block_cols, block_rows = numpy.nonzero(included)
+        col_idx.append(block_cols + start)
+        row_idx.append(block_rows)
+    empty = [numpy.empty(0, dtype=numpy.int64)]
+    return grid_x_left, grid_y_bottom, numpy.concatenate(col_idx + empty), numpy.concatenate(row_idx + empty)
+
+
+def write_grid_geojson(fout, grid_x_left, grid_y_bottom, col_idx, row_idx):
+    """Write grid cells as a GeoJSON FeatureCollection of Polygons with rid and cid properties.
+
+    The text of each feature is formatted directly (the same as dumping geojson Features, which round coordinates to
+    COORD_PRECISION decimal places) rather than building a geojson object for every grid cell.
+    """
+    x_left = [repr(round(x, COORD_PRECISION)) for x in grid_x_left.tolist()]
+    x_right = [repr(round(x + 0.001, COORD_PRECISION)) for x in grid_x_left.tolist()]
+    y_bottom = [repr(round(y, COORD_PRECISION)) for y in grid_y_bottom.tolist()]
+    y_top = [repr(round(y + 0.001, COORD_PRECISION)) for y in grid_y_bottom.tolist()]
+    rids = [round(y * 10**SCALE) for y in grid_y_bottom.tolist()]
+    cids = [round(x * 10**SCALE) for x in grid_x_left.tolist()]
     features = []
-    while countcols < cols:
-        # set x coordinate for this column
-        grid_x_left = xmin + (countcols * gridWidth)
-        countcols += 1
-        # reset count for rows
-        countrows = 0
-        while countrows < rows:
-            # update y coordinate for this row
-            grid_y_bottom = ymin + (countrows * gridHeight)
-            countrows += 1
-            # check if grid centroid contained in county boundary
-            bottomleftcorner = (grid_x_left, grid_y_bottom)
-            coords = [bottomleftcorner]
-            # add other three corners of gridcell before closing grid with starting point again
-            for i in [(0.001, 0), (0.001, 0.001), (0, 0.001), (0, 0)]:
-                coords.append((bottomleftcorner[0] + i[1], bottomleftcorner[1] + i[0]))
-            intersects = False
-            for corner in coords[1:]:
-                if boundary.contains(Point(corner)):
-                    intersects = True
-                    break
-            if intersects:
-                properties = {'rid': round(grid_y_bottom * 10**SCALE), 'cid': round(grid_x_left * 10**SCALE)}
-                features.append(Feature(geometry=Polygon([coords]), properties=properties))
-
-    with open(outputGridfn, 'w') as fout:
-        dump(FeatureCollection(features), fout)
+    for i, j in zip(col_idx.tolist(), row_idx.tolist()):
+        features.append(FEATURE_TEMPLATE.format(x_left[i], y_bottom[j], x_left[i], y_top[j], x_right[i], y_top[j],
+                                                x_right[i], y_bottom[j], x_left[i], y_bottom[j], rids[j], cids[i]))
+    fout.write('{"type": "FeatureCollection", "features": [')
+    fout.write(", ".join(features))
+    fout.write(']}')
+
+
+def grid_county(task):
+    """Grid one county (for a process pool)."""
+    feature, output_folder, grid_format = task
+    boundary = shape(feature['geometry'])
+    bb = boundary.bounds
+
+    xmin = bb[0]  # most western point
+    xmax = bb[2]  # most eastern point
+    ymin = bb[1]  # most southern point
+    ymax = bb[3]  # most northern point
+
+    gridHeight = 0.001
+    gridWidth = 0.001
+    xmin = floor(xmin * 10**SCALE) / 10**SCALE
+    ymax = ceil(ymax * 10**SCALE) / 10**SCALE
+
+    grid("{0}.geojson".format(os.path.join(output_folder, feature['properties']['FIPS'])),
+         xmin, xmax, ymin, ymax, gridHeight, gridWidth, boundary, grid_format)
+
 
 def main():
     """Generate grids for a list of counties."""
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("features_geojson", help="Path to GeoJSON with features to be gridded.")
+    parser.add_argument("features_geojson",
+                        help="Path to GeoJSON with features to be gridded (or to a raster grid .npz to export as "
+                             "GeoJSON).")
     parser.add_argument("output_folder", help="Folder to contain output grid GeoJSONs.")
+    parser.add_argument("--format", default="geojson", choices=["geojson", "raster", "both"],
+                        help="Write grids as GeoJSON polygons, compact raster grids (.npz), or both.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes that grid counties in parallel.")
     args = parser.parse_args()
 
+    if args.features_geojson.endswith(".npz"):
+        geojson_fn = os.path.join(args.output_folder,
+                                  os.path.basename(args.features_geojson).replace(".npz", ".geojson"))
+        RasterGrid.load(args.features_geojson).write_geojson(geojson_fn)
+        print("Exported {0} to {1}.".format(args.features_geojson, geojson_fn))
+        return
+
     with open(args.features_geojson, 'r') as fin:
         features_gj = json.load(fin)
 
     if not os.path.isdir(GRIDS_DIR):
         os.mkdir(GRIDS_DIR)
 
-    count = 0
     for feature in features_gj['features']:
         try:
             feature['properties']['FIPS'] = "{0}{1}".format(feature['properties']['STATE'], feature['properties']['COUNTY'])
         except:
             pass
-        count += 1
-        boundary = shape(feature['geometry'])
-        bb = boundary.bounds
-
-        xmin = bb[0]  # most western point
-        xmax = bb[2]  # most eastern point
-        ymin = bb[1]  # most southern point
-        ymax = bb[3]  # most northern point
+    tasks = [(feature, args.output_folder, args.format) for feature in features_gj['features']]
 
-        gridHeight = 0.001
-        gridWidth = 0.001
-        xmin = floor(xmin * 10**SCALE) / 10**SCALE
-        ymax = ceil(ymax * 10**SCALE) / 10**SCALE
-
-        grid("{0}.geojson".format(os.path.join(args.output_folder, feature['properties']['FIPS'])),
-             xmin, xmax, ymin, ymax, gridHeight, gridWidth, boundary)
-        if count % 150 == 0:
-            print("{0} counties complete.".format(count))
+    count = 0
+    if args.workers > 1:
+        with Pool(processes=args.workers) as pool:
+            for _ in pool.imap_unordered(grid_county, tasks):
+                count += 1
+                if count % 150 == 0:
+                    print("{0} counties complete.".format(count))
+    else:
+        for task in tasks:
+            grid_county(task)
+            count += 1
+            if count % 150 == 0:
+                print("{0} counties complete.".format(count))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
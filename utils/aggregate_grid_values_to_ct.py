@@ -1,15 +1,48 @@
-"""Aggregate grid values to census tracts and classify as above/below a given threshold. Used for safety routing."""
+"""Aggregate grid values to census tracts and classify as above/below a given threshold. Used for safety routing.
+
+Grid values are either an empath-grid CSV from preprocessing/generate_grid_scores.py or a crime cube (.npz) from
+preprocessing/crime_cube.py, in which case crimes are counted for --start_date through --end_date (and --categories).
+"""
 import csv
 import json
 import argparse
+import os
+import sys
 
 import numpy
 
+# the crime cube is defined alongside the scripts that generate grid values
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "preprocessing"))
+from crime_cube import CrimeCube
+
+
+def load_cube_counts(cube_fn, start_date, end_date, categories=None):
+    """Number of crimes in the categories (count_words) of each grid cell in a crime cube within a date window.
+
+    Args:
+        cube_fn: crime cube saved by preprocessing/crime_cube.py
+        start_date, end_date: first and last day (YYYY-MM-DD) of crimes to count
+        categories: crime categories to count (the cube's default categories if None)
+
+    Returns:
+        dictionary of grid cell ID ("cid,rid") to the number of crimes
+    """
+    cube = CrimeCube.load(cube_fn)
+    grid_scores = cube.grid_scores(start_date, end_date, categories)
+    data = {}
+    for (rid, cid), num_crimes in zip(cube.keys, grid_scores.count_words.tolist()):
+        data["{0},{1}".format(cid, rid)] = num_crimes
+    return data
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("empath_grid_csv")
+    parser.add_argument("empath_grid_csv", help="Empath-grid CSV or crime cube (.npz)")
     parser.add_argument("ct_grid_csv")
     parser.add_argument("ct_geojson")
+    parser.add_argument("--start_date", default="2016-01-01", help="First day (YYYY-MM-DD) of crimes (crime cube only)")
+    parser.add_argument("--end_date", default="2016-12-31", help="Last day (YYYY-MM-DD) of crimes (crime cube only)")
+    parser.add_argument("--categories", nargs="+", default=None, help="Crime categories to count (crime cube only)")
     args = parser.parse_args()
 
     # NOTE:
@@ -27,20 +60,24 @@ def main():
         expected_header = ['dangerous drugs', 'kidnapping & related offenses', 'cid',
                            'grand larceny of motor vehicle', 'felony assault', 'count_words', 'count_ugc',
                            'dangerous weapons', 'rid', 'assault 3 & related offenses', 'grand larceny']
-    data = {}
-    print("loading empath grid scores")
-    with open(args.empath_grid_csv, "r") as fin:
-        csvreader = csv.reader(fin)
-        found_header = next(csvreader)
-        num_crime_idx = found_header.index("count_words")
-        cid_idx = found_header.index("cid")
-        rid_idx = found_header.index("rid")
-        for col in expected_header:
-            assert col in found_header, "{0} not in header.".format(col)
-        for line in csvreader:
-            gid = "{0},{1}".format(line[cid_idx], line[rid_idx])
-            num_crimes = int(line[num_crime_idx])
-            data[gid] = num_crimes
+    if args.empath_grid_csv.endswith(".npz"):
+        print("counting crimes from {0} to {1} in crime cube".format(args.start_date, args.end_date))
+        data = load_cube_counts(args.empath_grid_csv, args.start_date, args.end_date, args.categories)
+    else:
+        data = {}
+        print("loading empath grid scores")
+        with open(args.empath_grid_csv, "r") as fin:
+            csvreader = csv.reader(fin)
+            found_header = next(csvreader)
+            num_crime_idx = found_header.index("count_words")
+            cid_idx = found_header.index("cid")
+            rid_idx = found_header.index("rid")
+            for col in expected_header:
+                assert col in found_header, "{0} not in header.".format(col)
+            for line in csvreader:
+                gid = "{0},{1}".format(line[cid_idx], line[rid_idx])
+                num_crimes = int(line[num_crime_idx])
+                data[gid] = num_crimes
 
     gid_to_ct = {}
     ct_to_gid = {}
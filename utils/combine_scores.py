@@ -1,19 +1,116 @@
-"""Combine two empath-grid files (e.g. Twitter and Flickr) into one."""
+"""Combine two empath-grid files (e.g. Twitter and Flickr) into one.
+
+If both files are raw-count snapshots (.npz) saved by preprocessing/generate_grid_scores.py, the counts are added
+exactly and the combined snapshot can also be saved (--snapshot_out). Otherwise, the counts are recovered from the
+logged fractions of the two CSV files.
+"""
 import csv
 import argparse
 import json
 from math import exp, log
 import os
 
+import numpy
 from empath import Empath
 
+
+def load_snapshot(snapshot_fn):
+    with numpy.load(snapshot_fn) as snapshot:
+        return {name: snapshot[name] for name in snapshot.files}
+
+
+def combine_snapshots(one, two):
+    """Add the raw counts of two snapshots (see GridScores.save in generate_grid_scores.py).
+
+    Grid cells are in the order of the first snapshot followed by any grid cells only in the second.
+    If only the first UGC from each user is included for each grid cell (first_ugc_only), users from snapshots of
+    different repositories are kept apart. Snapshots of the same repository can only be combined if they do not
+    share any users in the same grid cell, as the scores of that UGC cannot be separated from the rest.
+    """
+    if one['categories'].tolist() != two['categories'].tolist():
+        raise ValueError("Snapshots have different categories.")
+    if bool(one['fraction']) != bool(two['fraction']):
+        raise ValueError("Cannot combine crime counts with UGC fractions.")
+    if bool(one['first_ugc_only']) != bool(two['first_ugc_only']):
+        raise ValueError("Cannot combine a snapshot with first_ugc_only with one without.")
+
+    keys = list(zip(one['rid'].tolist(), one['cid'].tolist()))
+    rows = {keys[i]: i for i in range(0, len(keys))}
+    two_rows = []
+    for key in zip(two['rid'].tolist(), two['cid'].tolist()):
+        if key not in rows:
+            rows[key] = len(keys)
+            keys.append(key)
+        two_rows.append(rows[key])
+    two_rows = numpy.array(two_rows, dtype=numpy.int64)
+
+    combined = {'rid': numpy.array([k[0] for k in keys], dtype=numpy.int64),
+                'cid': numpy.array([k[1] for k in keys], dtype=numpy.int64),
+                'categories': one['categories'], 'fraction': one['fraction'], 'first_ugc_only': one['first_ugc_only']}
+    for name in ['count_ugc', 'count_words', 'scores']:
+        combined[name] = numpy.zeros((len(keys),) + one[name].shape[1:], dtype=one[name].dtype)
+        combined[name][:len(one[name])] += one[name]
+        combined[name][two_rows] += two[name]
+
+    one_users = one['users'].tolist()
+    two_users = two['users'].tolist()
+    if str(one['repo']) == str(two['repo']):
+        combined['repo'] = one['repo']
+    else:
+        combined['repo'] = numpy.array("{0}+{1}".format(one['repo'], two['repo']))
+        one_users = ["{0}:{1}".format(one['repo'], user) for user in one_users]
+        two_users = ["{0}:{1}".format(two['repo'], user) for user in two_users]
+    # re-code the second snapshot's (row, user) pairs with the combined rows and user IDs
+    user_ids = {one_users[i]: i for i in range(0, len(one_users))}
+    two_user_ids = numpy.array([user_ids.setdefault(user, len(user_ids)) for user in two_users], dtype=numpy.int64)
+    codes = two['user_codes']
+    two_codes = (two_rows[codes >> 32] << 32) | two_user_ids[codes & 0xffffffff]
+    if numpy.isin(two_codes, one['user_codes']).any():
+        raise ValueError("Snapshots have UGC from the same users in the same grid cells. Add the UGC to one snapshot "
+                         "with generate_grid_scores.py --update instead.")
+    combined['users'] = numpy.array(list(user_ids.keys()), dtype=str)
+    combined['user_codes'] = numpy.union1d(one['user_codes'], two_codes)
+    return combined
+
+
+def write_snapshot_csv(snapshot, fn_out):
+    count_ugc = snapshot['count_ugc']
+    count_words = snapshot['count_words']
+    scores = snapshot['scores']
+    fraction = bool(snapshot['fraction'])
+    if fraction:
+        has_words = (count_ugc > 0) & (count_words > 0)
+        scores = scores.copy()
+        scores[has_words] = numpy.log(scores[has_words] / count_words[has_words, numpy.newaxis] + 1)
+    with open(fn_out, 'w') as fout:
+        csvwriter = csv.writer(fout)
+        csvwriter.writerow(['rid', 'cid', 'count_ugc', 'count_words'] + snapshot['categories'].tolist())
+        for i in range(0, len(count_ugc)):
+            if fraction and count_ugc[i] > 0:
+                row_scores = scores[i].tolist()
+            else:
+                row_scores = scores[i].astype(numpy.int64).tolist()
+            csvwriter.writerow([int(snapshot['rid'][i]), int(snapshot['cid'][i]), int(count_ugc[i]),
+                                int(count_words[i])] + row_scores)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("fn_one")
     parser.add_argument("fn_two")
     parser.add_argument("fn_out")
+    parser.add_argument("--snapshot_out", default=None,
+                        help="File path to save the combined snapshot (only if combining snapshots)")
     args = parser.parse_args()
 
+    if args.fn_one.endswith(".npz") and args.fn_two.endswith(".npz"):
+        combined = combine_snapshots(load_snapshot(args.fn_one), load_snapshot(args.fn_two))
+        write_snapshot_csv(combined, args.fn_out)
+        if args.snapshot_out:
+            with open(args.snapshot_out, 'wb') as fout:
+                numpy.savez_compressed(fout, **combined)
+        return
+
     empath_categories = Empath().analyze("").keys()
 
     vals = {}
@@ -49,7 +146,7 @@ def main():
     keys = sorted(vals[grid_id].keys())
     keys.remove('rid')
     keys.remove('cid')
-    keys = ['rid','cid'] + keys 
+    keys = ['rid','cid'] + keys
 
     with open(args.fn_out, 'w') as fout:
         csvwriter = csv.DictWriter(fout, fieldnames = keys)